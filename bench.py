@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import time, sys, random
+import tracemalloc, tempfile, json
+import undo_search
+import search_depth
+from undo_search import *
+from synthetic_db import create_synthetic_db
+
+#name, USE_LINKS_FLAG, GRAPH_FLAG, ITERATIVE_FLAG
+ALPHA_BETA_MODES = (("link recursive", True, False, False),
+                    ("graph recursive", True, True, False),
+                    ("graph iterative", True, True, True))
+BOARD_MODE = ("board recursive", False, False, False)
+
+def bench_alpha_beta(s, repeat, modes=ALPHA_BETA_MODES):
+    results = []
+    for name, links_flag, graph_flag, iterative_flag in modes:
+        if not links_flag and not hasattr(chess.Board(), "transpositions"):
+            print("%s skipped, python-chess Board has no transpositions" % (name,))
+            continue
+        undo_search.USE_LINKS_FLAG = links_flag
+        undo_search.GRAPH_FLAG = graph_flag
+        undo_search.ITERATIVE_FLAG = iterative_flag
+        s.graph_history = {}
+        s.history_moves = {}
+        s.search_alpha_beta()
+        nodes = 0
+        t0 = time.time()
+        for i in range(repeat):
+            score, pv = s.search_alpha_beta()
+            nodes += s.alpha_beta_nodes
+        time_elapsed = time.time() - t0
+        results.append((name, score, pv, nodes, time_elapsed))
+    undo_search.USE_LINKS_FLAG = True
+    undo_search.GRAPH_FLAG = False
+    for name, score, pv, nodes, time_elapsed in results:
+        print("%-16s %i %s: %i nodes in %.3fs, %i nodes/s" % (name, score, " ".join(pv), nodes, time_elapsed, nodes/max(time_elapsed, 0.001)))
+    return results
+
+def bench_parallel(max_workers, repeat):
+    #graph alpha-beta with 1..max_workers processes, every run starts from empty history,
+    #pool is forked when UndoSearch starts, so each worker count gets its own UndoSearch
+    undo_search.GRAPH_FLAG = True
+    undo_search.USE_LINKS_FLAG = True
+    results = []
+    workers = 1
+    while workers<=max_workers:
+        undo_search.PARALLEL_WORKERS = workers if workers>1 else 0
+        s = UndoSearch(0, 0)
+        time_elapsed = 0
+        for i in range(repeat):
+            s.graph_history = {}
+            t0 = time.time()
+            score, pv = s.search_alpha_beta()
+            time_elapsed += time.time() - t0
+        results.append((workers, score, pv, time_elapsed/repeat))
+        s.close_parallel_pool()
+        s.writer.close()
+        workers *= 2
+    undo_search.PARALLEL_WORKERS = 0
+    undo_search.GRAPH_FLAG = False
+    s = UndoSearch(0, 0)
+    score, pv = s.search_alpha_beta()
+    print("serial link recursive: %i %s" % (score, " ".join(pv)))
+    for workers, score2, pv2, time_elapsed in results:
+        print("%2i workers: %i %s %.3fs, speedup %.2f, %s" % (workers, score2, " ".join(pv2), time_elapsed,
+            results[0][3]/max(time_elapsed, 0.001), "same" if (score2, pv2)==(score, pv) else "DIFFERENT"))
+    return results
+
+def random_game(board, plies):
+    moves = []
+    for i in range(plies):
+        legal_moves = list(board.legal_moves)
+        if not legal_moves: break
+        moves.append(random.choice(legal_moves))
+        board.push(moves[-1])
+    for m in moves:
+        board.pop()
+    return moves
+
+def bench_post_info(lines):
+    #info lines fed to NodeHandler as chess.uci engine reader does, 30 plies to board, 20 plies PV
+    random.seed(1)
+    board = chess.Board()
+    for m in random_game(board, 30):
+        board.push(m)
+    pv = random_game(board, 20)
+    log = Log("bench_info")
+    results = []
+    for name, interval in (("every line", 0), ("throttled", search_depth.PROGRESS_INTERVAL)):
+        search_depth.PROGRESS_INTERVAL = interval
+        handler = NodeHandler(10**12)
+        handler.log = log
+        handler.new_board(chess.STARTING_FEN, board, "bench")
+        t0 = time.time()
+        for i in range(lines):
+            handler.pre_info("")
+            handler.depth(i//100 + 1)
+            handler.seldepth(i//100 + 5)
+            handler.nodes(10000 + i*1000)
+            handler.score(i%50, None, False, False)
+            handler.pv(pv)
+            handler.post_info()
+        time_elapsed = time.time() - t0
+        results.append((name, time_elapsed))
+    log.print_s()
+    for name, time_elapsed in results:
+        log.print_s("post_info %-10s: %i info lines in %.3fs, %i lines/s" % (name, lines, time_elapsed, lines/max(time_elapsed, 0.001)))
+    return results
+
+def bench_positions():
+    #startup of position rows from chess.db: all rows as lists (old) and PositionStore
+    db = sqlite3.connect(db_name)
+    c = db.cursor()
+    for name, load in (("full rows", lambda: {info[KEY]: list(info) for info in c.execute("SELECT * FROM analysis")}),
+                       ("PositionStore", lambda: PositionStore(c, KEY))):
+        tracemalloc.start()
+        t0 = time.time()
+        positions = load()
+        time_elapsed = time.time() - t0
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("%-13s: %i positions in %.3fs, %.1fMB, %i bytes/position" % (name, len(positions), time_elapsed, size/2**20, size/max(len(positions), 1)))
+        del positions
+    db.close()
+
+def bench_suite(positions, branching, ply, output):
+    #synthetic chess.db and mock_engine.py in new directory, results as JSON for tracking regressions
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    output = os.path.abspath(output)
+    results = {"time": get_time_str(), "python": sys.version.split()[0], "positions": positions, "branching": branching}
+    os.chdir(tempfile.mkdtemp(prefix="bench_"))
+    print("benchmark directory: %s" % (os.getcwd(),))
+    t0 = time.time()
+    positions, links = create_synthetic_db(positions, branching)
+    results["synthetic_db"] = {"positions": positions, "links": links, "seconds": time.time() - t0}
+
+    s = UndoSearch(0, 0)
+    t0 = time.time()
+    s.build_links()
+    loaded = time.time() - t0
+    t0 = time.time()
+    s.rebuild_links()
+    results["build_links"] = {"links": s.link_count, "loaded_seconds": loaded, "generated_seconds": time.time() - t0}
+
+    results["search_alpha_beta"] = {name: {"score": score, "pv": " ".join(pv), "nodes": nodes, "seconds": time_elapsed, "nodes_per_second": nodes/max(time_elapsed, 0.001)}
+                                    for name, score, pv, nodes, time_elapsed in bench_alpha_beta(s, 3, ALPHA_BETA_MODES + (BOARD_MODE,))}
+
+    lines = 20000
+    results["post_info"] = {name: {"lines": lines, "seconds": time_elapsed, "lines_per_second": lines/max(time_elapsed, 0.001)}
+                            for name, time_elapsed in bench_post_info(lines)}
+
+    #rows of existing positions stored again, links are already in link table
+    rows = [list(s.positions[key]) for key in list(s.positions)[:5000]]
+    for info in rows:
+        s.store_result(info)
+    s.links2store = [(s.positions.entries[pos].hash, s.positions.entries[pos2].hash, m) for pos, pos2_dict in s.link_to.items() for pos2, m in pos2_dict.items()][:5000]
+    t0 = time.time()
+    s.commit()
+    s.writer.sync()
+    time_elapsed = time.time() - t0
+    results["commit"] = {"rows": len(rows), "links": 5000, "seconds": time_elapsed, "rows_per_second": len(rows)/max(time_elapsed, 0.001)}
+    s.writer.close()
+    print("commit: %i rows in %.3fs" % (len(rows), time_elapsed))
+
+    #search_depth.py with mock engine at full speed, searches of 10 info lines
+    os.environ["MOCK_LINES_PER_SECOND"] = "0"
+    search_depth.stockfish_script = os.path.join(package_dir, "mock_engine.py")
+    an = Analysis(int(os.environ.get("MOCK_NODES_PER_LINE", 50000))*10)
+    t0 = time.time()
+    cpu0 = time.process_time()
+    an.search_depth(ply, None)
+    time_elapsed = time.time() - t0
+    analysed = an.new_pos + an.mate_count
+    results["search_depth"] = {"ply": ply, "positions": analysed, "seconds": time_elapsed, "driver_cpu_seconds": time.process_time() - cpu0,
+                               "positions_per_second": analysed/max(time_elapsed, 0.001)}
+    print("search_depth: %i positions in %.3fs" % (analysed, time_elapsed))
+
+    if output=="-":
+        json.dump(results, sys.stdout, indent=1)
+    else:
+        with open(output, "w") as fp:
+            json.dump(results, fp, indent=1)
+        print("results: %s" % (output,))
+    return results
+
+if __name__=="__main__":
+    #run where chess.db is, engines are not started
+    #bench.py info [lines] measures NodeHandler info line processing only
+    #bench.py parallel [max_workers] runs graph alpha-beta with 1, 2, 4.. processes
+    #bench.py positions compares memory and time of loading position rows
+    if len(sys.argv)>1 and sys.argv[1]=="info":
+        if len(sys.argv)>2: lines = int(sys.argv[2])
+        else: lines = 100000
+        bench_post_info(lines)
+        sys.exit()
+    if len(sys.argv)>1 and sys.argv[1]=="suite":
+        #bench.py suite [positions] [branching] [ply] [output.json], output - prints JSON
+        args = sys.argv[2:] + [None]*4
+        bench_suite(int(args[0] or 20000), int(args[1] or 3), int(args[2] or 1), args[3] or "bench.json")
+        sys.exit()
+    if len(sys.argv)>1 and sys.argv[1]=="parallel":
+        if len(sys.argv)>2: max_workers = int(sys.argv[2])
+        else: max_workers = os.cpu_count()
+        bench_parallel(max_workers, 3)
+        sys.exit()
+    if len(sys.argv)>1 and sys.argv[1]=="positions":
+        bench_positions()
+        sys.exit()
+    if len(sys.argv)>1: repeat = int(sys.argv[1])
+    else: repeat = 3
+    s = UndoSearch(0, 0)
+    bench_alpha_beta(s, repeat)
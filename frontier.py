@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import heapq
+import chess
+
+class PVLeafFrontier:
+    #expand only the leaf at the end of alpha-beta PV
+    name = "pv leaf"
+
+    def __init__(self, s):
+        self.s = s
+
+    def select(self, pv, k):
+        return [pv]
+
+class MarginFrontier(PVLeafFrontier):
+    #score margin best-first: cost of a leaf is the sum of how much worse than best sibling
+    #the moves leading to it are (PV leaf costs 0), k cheapest leaves are expanded together
+    name = "margin"
+
+    def select(self, pv, k):
+        s = self.s
+        board = chess.Board(s.starting_pos)
+        root = s.best_position()
+        values = self.node_values(root, board.turn)
+        heap = [(0, 0, root, [])]
+        seen = set()
+        seq = 1
+        variations = []
+        #PV leaf first, its cost is 0 but repetitions are scored exactly only by alpha-beta
+        pos = root
+        for m in pv:
+            pos = [pos2 for pos2, m2 in s.get_pos2_dict(pos).items() if m2==m][0]
+        if not s.has_links(pos) and not self.game_over(pv):
+            variations.append(pv)
+            seen.add(pos)
+        while heap and len(variations)<k:
+            cost, i, pos, moves = heapq.heappop(heap)
+            if pos in seen: continue
+            seen.add(pos)
+            pos2_dict = s.get_pos2_dict(pos)
+            if not pos2_dict:
+                if not self.game_over(moves):
+                    variations.append(moves)
+                continue
+            for pos2 in pos2_dict:
+                if pos2 in seen: continue
+                margin = max(values[pos] + values[pos2], 0)
+                heapq.heappush(heap, (cost + margin, seq, pos2, moves + [pos2_dict[pos2]]))
+                seq += 1
+        return variations
+
+    def game_over(self, moves):
+        board = chess.Board(self.s.starting_pos)
+        for m in moves:
+            board.push_uci(m)
+        return board.is_game_over()
+
+    def node_values(self, root, turn):
+        #negamax values of all reachable positions, position already on path counts as draw,
+        #values are only for ordering so path dependency of repetitions is ignored
+        s = self.s
+        if not s.has_links(root):
+            return {root: s.get_score(root)}
+        values = {}
+        on_path = {root}
+        stack = [[root, turn, iter(s.get_pos2_dict(root)), None]]
+        while stack:
+            frame = stack[-1]
+            pos, turn = frame[0], frame[1]
+            for pos2 in frame[2]:
+                if pos2 in on_path:
+                    score = s.draw_score(not turn)
+                elif pos2 in values:
+                    score = values[pos2]
+                elif not s.has_links(pos2):
+                    score = values[pos2] = s.get_score(pos2)
+                else:
+                    on_path.add(pos2)
+                    stack.append([pos2, not turn, iter(s.get_pos2_dict(pos2)), None])
+                    break
+                if frame[3]==None or -score>frame[3]: frame[3] = -score
+            else:
+                stack.pop()
+                on_path.discard(pos)
+                values[pos] = frame[3]
+                if stack and (stack[-1][3]==None or -frame[3]>stack[-1][3]):
+                    stack[-1][3] = -frame[3]
+        return values
+
+FRONTIERS = {"pv": PVLeafFrontier, "margin": MarginFrontier}
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import chess
+import itertools
+from array import array
+
+def move2code(m):
+    move = chess.Move.from_uci(m)
+    return move.from_square | move.to_square<<6 | (move.promotion or 0)<<12
+
+def code2uci(code):
+    return chess.Move(code & 63, code>>6 & 63, code>>12 or None).uci()
+
+class LinkGraph:
+    #positions as node ids with normalized scores in arrays, links in CSR form:
+    #edges of node are children/moves[offsets[node]:offsets[node+1]] plus extra edges added after last compact
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+        self.scores = array("i")
+        self.offsets = array("q", [0])
+        self.children = array("i")
+        self.moves = array("H")
+        self.extra = {}
+        self.extra_count = 0
+        self.uci = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add_node(self, key, score):
+        node = self.ids.get(key)
+        if node is None:
+            node = len(self.keys)
+            self.ids[key] = node
+            self.keys.append(key)
+            self.scores.append(score)
+            self.offsets.append(self.offsets[-1])
+        else:
+            self.scores[node] = score
+        return node
+
+    def add_edge(self, key1, key2, m):
+        node1 = self.ids[key1]
+        node2 = self.ids[key2]
+        for node, code in self.edges(node1):
+            if node==node2: return
+        self.extra.setdefault(node1, []).append((node2, move2code(m)))
+        self.extra_count += 1
+        if self.extra_count > len(self.children)//8 + 10000:
+            self.compact()
+
+    def load_edges(self, src, dst, codes):
+        #CSR arrays of graph without edges from edge arrays in any order, e.g. link table at startup
+        counts = [0]*(len(self.keys) + 1)
+        for node in src:
+            counts[node+1] += 1
+        self.offsets = array("q", itertools.accumulate(counts))
+        fill = array("q", self.offsets)
+        self.children = array("i", bytes(4*len(src)))
+        self.moves = array("H", bytes(2*len(src)))
+        for node1, node2, code in zip(src, dst, codes):
+            i = fill[node1]
+            self.children[i] = node2
+            self.moves[i] = code
+            fill[node1] = i + 1
+        self.extra = {}
+        self.extra_count = 0
+
+    def has_edges(self, node):
+        return self.offsets[node]<self.offsets[node+1] or node in self.extra
+
+    def edges(self, node):
+        i0 = self.offsets[node]
+        i1 = self.offsets[node+1]
+        lst = list(zip(self.children[i0:i1], self.moves[i0:i1]))
+        if self.extra and node in self.extra:
+            lst.extend(self.extra[node])
+        return lst
+
+    def move_uci(self, code):
+        m = self.uci.get(code)
+        if m is None:
+            m = self.uci[code] = code2uci(code)
+        return m
+
+    def compact(self):
+        offsets = array("q", [0])
+        children = array("i")
+        moves = array("H")
+        for node in range(len(self.keys)):
+            for node2, code in self.edges(node):
+                children.append(node2)
+                moves.append(code)
+            offsets.append(len(children))
+        self.offsets, self.children, self.moves = offsets, children, moves
+        self.extra = {}
+        self.extra_count = 0
+
+    def memory(self):
+        return sum(a.itemsize*len(a) for a in (self.scores, self.offsets, self.children, self.moves))
+
+def build_link_graph(positions, link_to, score_fn):
+    g = LinkGraph()
+    for key in positions:
+        g.add_node(key, score_fn(key))
+    g.offsets = array("q", [0])
+    for key in g.keys:
+        pos2_dict = link_to.get(key, {})
+        for pos2 in pos2_dict:
+            g.children.append(g.ids[pos2])
+            g.moves.append(move2code(pos2_dict[pos2]))
+        g.offsets.append(len(g.children))
+    return g
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import sys, os, time
+import sqlite3
+import chess
+
+#engine logs written by log_with_timestamp.py: "timestamp line", both directions in same file
+def create_index_db(index_name):
+    db = sqlite3.connect(index_name, 60.0)
+    c = db.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS replay (engine TEXT, pos TEXT, nodes INTEGER, time INTEGER, depth INTEGER, info TEXT, bestmove TEXT, log TEXT)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS replay_index ON replay (engine, pos)")
+    c.execute("CREATE TABLE IF NOT EXISTS indexed_log (name TEXT PRIMARY KEY, size INTEGER)")
+    return db, c
+
+def fen2key(fen):
+    return " ".join(fen.split()[:-2])
+
+def parse_position(l):
+    #l: words of "position startpos|fen ... [moves ...]"
+    if l[1]=="startpos":
+        board = chess.Board()
+        i = 2
+    else:
+        board = chess.Board(" ".join(l[2:8]))
+        i = 8
+    if len(l)>i and l[i]=="moves":
+        for m in l[i+1:]:
+            board.push_uci(m)
+    return board
+
+def info_value(l, name):
+    if name in l:
+        return int(l[l.index(name)+1])
+    return 0
+
+def parse_log(filename):
+    #yields (pos, info line, bestmove line) of every finished single PV search
+    multipv = 1
+    board = None
+    searching = False
+    last_info = None
+    for line in open(filename, errors="replace"):
+        l = line.split()
+        if len(l)<2: continue
+        l = l[1:]
+        if l[0]=="setoption" and len(l)>=5 and l[2]=="MultiPV":
+            multipv = int(l[4])
+        elif l[0]=="position":
+            try:
+                board = parse_position(l)
+            except ValueError:
+                board = None
+        elif l[0]=="go":
+            searching = board!=None and multipv==1 and "searchmoves" not in l
+            last_info = None
+        elif l[0]=="info" and searching:
+            if "score" in l and "pv" in l and info_value(l, "multipv")<=1 and "lowerbound" not in l and "upperbound" not in l:
+                last_info = " ".join(l)
+        elif l[0]=="bestmove":
+            #bestmove of other position means log is not from one engine
+            if searching and last_info and len(l)>1 and l[1]!="(none)" and chess.Move.from_uci(l[1]) in board.legal_moves:
+                yield fen2key(board.fen()), last_info, " ".join(l)
+            searching = False
+
+def index_logs(index_name, engine, filenames):
+    db, c = create_index_db(index_name)
+    t0 = time.time()
+    total = 0
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        name = os.path.abspath(filename)
+        if c.execute("SELECT 1 FROM indexed_log WHERE name=? AND size=?", (name, size)).fetchone():
+            continue
+        rows = []
+        for pos, info, bestmove in parse_log(filename):
+            l = info.split()
+            rows.append((engine, pos, info_value(l, "nodes"), info_value(l, "time"), info_value(l, "depth"), info, bestmove, name))
+        #deepest search of position wins
+        c.executemany("INSERT INTO replay VALUES(?,?,?,?,?,?,?,?) ON CONFLICT(engine, pos) DO UPDATE SET nodes=excluded.nodes, time=excluded.time, depth=excluded.depth, info=excluded.info, bestmove=excluded.bestmove, log=excluded.log WHERE excluded.nodes>replay.nodes", rows)
+        c.execute("INSERT OR REPLACE INTO indexed_log VALUES(?,?)", (name, size))
+        db.commit()
+        total += len(rows)
+        print("%s: %i searches" % (filename, len(rows)))
+    count = c.execute("SELECT COUNT(*) FROM replay WHERE engine=?", (engine,)).fetchone()[0]
+    print("%i searches indexed in %.3fs, %s positions: %i" % (total, time.time() - t0, engine, count))
+    db.close()
+
+if __name__=="__main__":
+    #log_index.py log_index.db stockfish 2017-*.log
+    #log_index.py log_index.db brainfish brainfish_*.log
+    index_logs(sys.argv[1], sys.argv[2], sys.argv[3:])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import os, time, json
+import threading, functools, bisect
+
+#timers, counters and per engine histograms, written every interval as one JSON line
+#and as Prometheus text format file for a local scraper (node_exporter textfile collector)
+METRICS_INTERVAL = 10.0
+METRICS_PREFIX = "chess_"
+NPS_BUCKETS = [10**k*m for k in range(4, 9) for m in (1, 2, 5)]
+TBHITS_BUCKETS = [0] + [10**k for k in range(7)]
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1) #last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    #disabled: timed functions cost one attribute check, count/observe return at once
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.t0 = time.time()
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self, basename, interval=METRICS_INTERVAL):
+        #log/metrics_<basename>_<time>.jsonl keeps every snapshot, log/<basename>.prom only the latest
+        if not self.enabled or self.thread: return
+        if not os.path.exists("log"): os.mkdir("log")
+        self.t0 = time.time()
+        self.jsonl_name = "log/metrics_%s_%s.jsonl" % (basename, time.strftime("%Y%m%d_%H%M%S"))
+        self.prom_name = "log/%s.prom" % (basename,)
+        self.interval = interval
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def close(self):
+        if not self.thread: return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.write()
+
+    def timed(self, name):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled: return fn(*args, **kwargs)
+                t0 = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.add_time(name, time.perf_counter() - t0)
+            return wrapper
+        return decorator
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds>timer[2]: timer[2] = seconds
+
+    def count(self, name, n=1):
+        if not self.enabled: return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe_engine(self, engine, nodes, tbhits, time_ms):
+        #one finished engine search, time in milliseconds as in info lines
+        if not self.enabled or not time_ms: return
+        with self.lock:
+            hists = self.histograms.get(engine)
+            if hists is None:
+                hists = self.histograms[engine] = {"nps": Histogram(NPS_BUCKETS), "tbhits": Histogram(TBHITS_BUCKETS)}
+            hists["nps"].observe(nodes*1000/time_ms)
+            hists["tbhits"].observe(tbhits)
+
+    def snapshot(self):
+        with self.lock:
+            return {"time": time.time(),
+                    "elapsed": time.time() - self.t0,
+                    "timers": {name: {"calls": calls, "seconds": seconds, "max": max_seconds}
+                               for name, (calls, seconds, max_seconds) in self.timers.items()},
+                    "counters": dict(self.counters),
+                    "histograms": {engine: {name: {"buckets": h.buckets, "counts": list(h.counts), "sum": h.sum, "count": h.count}
+                                            for name, h in hists.items()}
+                                   for engine, hists in self.histograms.items()}}
+
+    def write(self):
+        data = self.snapshot()
+        with open(self.jsonl_name, "a") as fp:
+            fp.write(json.dumps(data) + "\n")
+        #scraper must never read half written file
+        tmp_name = self.prom_name + ".tmp"
+        with open(tmp_name, "w") as fp:
+            fp.write(self.prometheus_str(data))
+        os.replace(tmp_name, self.prom_name)
+
+    def prometheus_str(self, data):
+        p = METRICS_PREFIX
+        lines = ["# TYPE %suptime_seconds gauge" % (p,), "%suptime_seconds %.3f" % (p, data["elapsed"])]
+        lines.append("# TYPE %stimer_calls_total counter" % (p,))
+        lines += ['%stimer_calls_total{name="%s"} %i' % (p, name, t["calls"]) for name, t in sorted(data["timers"].items())]
+        lines.append("# TYPE %stimer_seconds_total counter" % (p,))
+        lines += ['%stimer_seconds_total{name="%s"} %.6f' % (p, name, t["seconds"]) for name, t in sorted(data["timers"].items())]
+        lines.append("# TYPE %stimer_max_seconds gauge" % (p,))
+        lines += ['%stimer_max_seconds{name="%s"} %.6f' % (p, name, t["max"]) for name, t in sorted(data["timers"].items())]
+        for name, value in sorted(data["counters"].items()):
+            lines.append("# TYPE %s%s_total counter" % (p, name))
+            lines.append("%s%s_total %i" % (p, name, value))
+        for hist_name in ("nps", "tbhits"):
+            lines.append("# TYPE %sengine_%s histogram" % (p, hist_name))
+            for engine, hists in sorted(data["histograms"].items()):
+                h = hists[hist_name]
+                total = 0
+                for le, n in zip(h["buckets"] + ["+Inf"], h["counts"]):
+                    total += n
+                    lines.append('%sengine_%s_bucket{engine="%s",le="%s"} %i' % (p, hist_name, engine, le, total))
+                lines.append('%sengine_%s_sum{engine="%s"} %.3f' % (p, hist_name, engine, h["sum"]))
+                lines.append('%sengine_%s_count{engine="%s"} %i' % (p, hist_name, engine, h["count"]))
+        return "\n".join(lines) + "\n"
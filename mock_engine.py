@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import sys, os, time, zlib, random
+import threading
+import chess
+
+#deterministic UCI engine for benchmarks: scores and PVs depend only on position and depth,
+#info lines at MOCK_LINES_PER_SECOND (0: as fast as possible), MOCK_NODES_PER_LINE nodes each
+MOCK_LINES_PER_SECOND = int(os.environ.get("MOCK_LINES_PER_SECOND", 200))
+MOCK_NODES_PER_LINE = int(os.environ.get("MOCK_NODES_PER_LINE", 50000))
+MOCK_NPS = 2*10**6 #reported nps, time of info lines is nodes/MOCK_NPS
+MOCK_PV_PLIES = 12
+
+class MockEngine:
+    def __init__(self):
+        self.board = chess.Board()
+        self.multipv = 1
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.out_lock = threading.Lock()
+
+    def write(self, s):
+        with self.out_lock:
+            sys.stdout.write(s + "\n")
+            sys.stdout.flush()
+
+    def line_score(self, fen, move, depth):
+        #score of move from side to move, changes every 4 plies of depth like a real search
+        r = random.Random(zlib.crc32(("%s %s %i" % (fen, move, depth//4)).encode()))
+        return r.randint(-150, 150)
+
+    def pv(self, board, move):
+        board = board.copy()
+        pv = [move]
+        board.push(move)
+        for i in range(MOCK_PV_PLIES - 1):
+            legal_moves = list(board.generate_legal_moves())
+            if not legal_moves: break
+            move = legal_moves[zlib.crc32(board.fen().encode()) % len(legal_moves)]
+            pv.append(move)
+            board.push(move)
+        return " ".join(map(str, pv))
+
+    def search(self, searchmoves, nodes_limit, movetime):
+        board = self.board
+        moves = [m for m in board.generate_legal_moves() if not searchmoves or str(m) in searchmoves]
+        if not moves:
+            self.write("info depth 0 score %s" % ("mate 0" if board.is_check() else "cp 0"))
+            self.write("bestmove (none)")
+            return
+        fen = board.fen()
+        pvs = {}
+        lines = min(self.multipv, len(moves))
+        nodes = 0
+        t0 = time.time()
+        best = moves[0]
+        for depth in range(1, 128):
+            scored = sorted(((self.line_score(fen, m, depth), str(m), m) for m in moves), reverse=True)
+            best = scored[0][2]
+            for k in range(lines):
+                score, uci, m = scored[k]
+                nodes += MOCK_NODES_PER_LINE
+                if m not in pvs: pvs[m] = self.pv(board, m)
+                self.write("info depth %i seldepth %i multipv %i score cp %i nodes %i nps %i tbhits 0 time %i pv %s" % (
+                    depth, depth + 6, k + 1, score, nodes, MOCK_NPS, nodes*1000//MOCK_NPS, pvs[m]))
+                if MOCK_LINES_PER_SECOND:
+                    if self.stop_event.wait(1/MOCK_LINES_PER_SECOND): break
+                elif self.stop_event.is_set(): break
+            if self.stop_event.is_set(): break
+            if nodes_limit and nodes>=nodes_limit: break
+            if movetime and (time.time() - t0)*1000>=movetime: break
+        self.write("bestmove %s" % (best,))
+
+    def go(self, l):
+        searchmoves = []
+        if "searchmoves" in l:
+            searchmoves = [m for m in l[l.index("searchmoves")+1:] if len(m) in (4, 5) and m[1].isdigit()]
+        nodes_limit = int(l[l.index("nodes")+1]) if "nodes" in l else 0
+        movetime = float(l[l.index("movetime")+1]) if "movetime" in l else 0
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.search, args=(searchmoves, nodes_limit, movetime))
+        self.thread.start()
+
+    def wait_search(self):
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def loop(self):
+        for line in sys.stdin:
+            l = line.split()
+            if not l: continue
+            if l[0]=="uci":
+                self.write("id name mock_engine")
+                self.write("option name MultiPV type spin default 1 min 1 max 500")
+                self.write("uciok")
+            elif l[0]=="isready":
+                self.write("readyok")
+            elif l[0]=="setoption" and len(l)>=5 and l[2]=="MultiPV":
+                self.multipv = int(l[4])
+            elif l[0]=="position":
+                self.wait_search()
+                if l[1]=="startpos":
+                    self.board = chess.Board()
+                else:
+                    self.board = chess.Board(" ".join(l[2:8]))
+                if "moves" in l:
+                    for m in l[l.index("moves")+1:]:
+                        self.board.push_uci(m)
+            elif l[0]=="go":
+                self.wait_search()
+                self.go(l)
+            elif l[0]=="stop":
+                self.stop_event.set()
+                self.wait_search()
+            elif l[0]=="quit":
+                self.stop_event.set()
+                self.wait_search()
+                break
+
+if __name__=="__main__":
+    #mock_engine.py, or as engine script of search_depth.py/undo_search.py when benchmarking
+    MockEngine().loop()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import os, resource
+import collections
+from search_depth import ANALYSIS_COLUMNS, SCORE_TYPE, SCORE, PV, HASH, BUDGET
+
+POSITION_CACHE_SIZE = 10000 #full analysis rows kept in LRU
+
+def resident_mb():
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+class Entry:
+    #resident part of analysis row, enough for alpha-beta, links and budget rule of store_result
+    __slots__ = ("score_type", "score", "move", "hash", "budget")
+
+    def __init__(self, score_type, score, move, hash, budget):
+        self.score_type = score_type
+        self.score = score
+        self.move = move
+        self.hash = hash
+        self.budget = budget or 0
+
+class PositionStore:
+    #analysis rows by key column, only Entry of each position stays in memory,
+    #full rows (fen, moves, pv) are read from SQLite through LRU when needed,
+    #rows stored in this session are kept whole until writer has committed them, then they move to LRU.
+    #Reads of rows not resident use main thread cursor c, so only main thread may index the store
+    def __init__(self, c, key_column, cache_size=POSITION_CACHE_SIZE, load=True):
+        self.c = c
+        self.key_column = key_column
+        self.cache_size = cache_size
+        self.entries = {}
+        self.rows = {}
+        self.row_seq = {} #key: writer statement number of its last store
+        self.pending = collections.deque() #(statement number, keys) not yet committed
+        self.lru = collections.OrderedDict()
+        self.strings = {}
+        self.hits = 0
+        self.misses = 0
+        key_name = ANALYSIS_COLUMNS[key_column]
+        self.select = "SELECT * FROM analysis WHERE %s=?" % (key_name,)
+        self.load_sql = "SELECT %s, score_type, score, pv, hash, budget FROM analysis" % (key_name,)
+        if load: self.load()
+
+    def load(self):
+        for key, score_type, score, pv, h, budget in self.c.execute(self.load_sql):
+            self.entries[key] = Entry(self.intern(score_type), score, self.intern(pv.split(" ", 1)[0]), h, budget)
+
+    def add_row(self, info):
+        #entry of row read from SQLite, row itself is not kept
+        key = info[self.key_column]
+        self.lru.pop(key, None)
+        self.entries[key] = Entry(self.intern(info[SCORE_TYPE]), info[SCORE], self.intern(info[PV].split(" ", 1)[0]), info[HASH], info[BUDGET])
+
+    def intern(self, s):
+        #few distinct moves and score types, one string object for each
+        return self.strings.setdefault(s, s)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        #main thread only, misses are read with self.c
+        info = self.rows.get(key)
+        if info is not None:
+            return info
+        info = self.lru.get(key)
+        if info is not None:
+            self.hits += 1
+            self.lru.move_to_end(key)
+            return info
+        if key not in self.entries:
+            raise KeyError(key)
+        self.misses += 1
+        info = list(self.c.execute(self.select, (key,)).fetchone())
+        self.add_lru(key, info)
+        return info
+
+    def add_lru(self, key, info):
+        self.lru[key] = info
+        if len(self.lru)>self.cache_size:
+            self.lru.popitem(last=False)
+
+    def written(self, keys, seq):
+        #rows of keys were queued to writer as statement number seq
+        for key in keys:
+            self.row_seq[key] = seq
+        self.pending.append((seq, keys))
+
+    def release(self, done_seq):
+        #rows committed by writer up to statement number done_seq can be read back from SQLite,
+        #keys stored again later stay until their last store is committed
+        while self.pending and self.pending[0][0]<=done_seq:
+            seq, keys = self.pending.popleft()
+            for key in keys:
+                if self.row_seq.get(key, done_seq + 1)>done_seq: continue
+                del self.row_seq[key]
+                self.add_lru(key, self.rows.pop(key))
+
+    def __setitem__(self, key, info):
+        self.rows[key] = info
+        self.lru.pop(key, None)
+        self.entries[key] = Entry(self.intern(info[SCORE_TYPE]), info[SCORE], self.intern(info[PV].split(" ", 1)[0]), info[HASH], info[BUDGET])
+
+    def stats_str(self):
+        return "position rows: %i resident, %i uncommitted, LRU %i hits %i misses" % (
+            len(self.entries), len(self.rows), self.hits, self.misses)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import sys
+import sqlite3, subprocess
+import queue, threading
+from log_index import fen2key, parse_position, info_value
+
+#answers go from log_index.py index, real engine is started only for first miss
+REPLAY_STOP_WAIT = 0.5 #seconds to wait for stop after replayed infinite search, then real engine continues
+
+class ReplayEngine:
+    def __init__(self, index_name, engine, real_command):
+        self.db = sqlite3.connect(index_name, 60.0)
+        self.engine = engine
+        self.real_command = real_command
+        self.real = None
+        self.real_searching = False
+        self.options = []
+        self.multipv = 1
+        self.position = None
+        self.pos = None
+        self.hits = 0
+        self.misses = 0
+        self.lines = queue.Queue()
+        self.out_lock = threading.Lock()
+
+    def write(self, s):
+        with self.out_lock:
+            sys.stdout.write(s + "\n")
+            sys.stdout.flush()
+
+    def read_stdin(self):
+        for line in sys.stdin:
+            self.lines.put(line)
+        self.lines.put("quit\n")
+
+    def start_real(self):
+        self.real = subprocess.Popen(self.real_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+        self.send_real("uci")
+        while not self.real.stdout.readline().startswith("uciok"): pass
+        for line in self.options:
+            self.send_real(line)
+        self.send_real("isready")
+        while not self.real.stdout.readline().startswith("readyok"): pass
+        threading.Thread(target=self.forward_real, daemon=True).start()
+
+    def send_real(self, line):
+        self.real.stdin.write(line + "\n")
+        self.real.stdin.flush()
+
+    def forward_real(self):
+        for line in self.real.stdout:
+            if line.startswith("readyok"): continue
+            if line.startswith("bestmove"):
+                self.real_searching = False
+            self.write(line.rstrip())
+
+    def go_real(self, go_line):
+        self.misses += 1
+        if not self.real: self.start_real()
+        self.real_searching = True
+        self.send_real(self.position)
+        self.send_real(go_line)
+
+    def lookup(self, l):
+        #recorded search with at least requested nodes/movetime, None for infinite means any
+        if self.pos==None or self.multipv!=1 or "searchmoves" in l:
+            return None
+        row = self.db.execute("SELECT nodes, time, info, bestmove FROM replay WHERE engine=? AND pos=?", (self.engine, self.pos)).fetchone()
+        if row is None: return None
+        nodes, ms, info, bestmove = row
+        if "nodes" in l and nodes<info_value(l, "nodes"): return None
+        if "movetime" in l and ms<float(l[l.index("movetime")+1]): return None
+        return info, bestmove
+
+    def go(self, line):
+        l = line.split()
+        res = self.lookup(l)
+        if res is None:
+            self.go_real(line)
+            return
+        info, bestmove = res
+        self.write(info)
+        if "infinite" not in l:
+            self.hits += 1
+            self.write(bestmove)
+            return
+        #infinite: caller stops when replayed info is enough, otherwise real engine searches on
+        try:
+            line2 = self.lines.get(timeout=REPLAY_STOP_WAIT)
+        except queue.Empty:
+            self.go_real(line)
+            return
+        self.hits += 1
+        self.write(bestmove)
+        if not line2.startswith("stop"):
+            self.lines.put(line2)
+
+    def loop(self):
+        threading.Thread(target=self.read_stdin, daemon=True).start()
+        while True:
+            line = self.lines.get().strip()
+            l = line.split()
+            if not l: continue
+            if l[0]=="uci":
+                self.write("id name replay %s" % (self.engine,))
+                self.write("uciok")
+            elif l[0]=="isready":
+                self.write("readyok")
+            elif l[0]=="setoption":
+                self.options.append(line)
+                if len(l)>=5 and l[2]=="MultiPV": self.multipv = int(l[4])
+                if self.real: self.send_real(line)
+            elif l[0]=="ucinewgame":
+                if self.real: self.send_real(line)
+            elif l[0]=="position":
+                self.position = line
+                try:
+                    self.pos = fen2key(parse_position(l).fen())
+                except ValueError:
+                    self.pos = None
+            elif l[0]=="go":
+                self.go(line)
+            elif l[0]=="stop":
+                if self.real_searching: self.send_real(line)
+            elif l[0]=="quit":
+                if self.real:
+                    self.send_real(line)
+                    self.real.wait()
+                sys.stderr.write("replay %s: %i hits, %i misses\n" % (self.engine, self.hits, self.misses))
+                break
+
+if __name__=="__main__":
+    #replay_engine.py log_index.db stockfish stockfish_log_time
+    ReplayEngine(sys.argv[1], sys.argv[2], sys.argv[3:]).loop()
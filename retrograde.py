@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+import numpy as np
+
+RETROGRADE_MAX_PASSES = 1000
+
+def retrograde_values(offsets, children, leaf_scores, draw_scores, mate_score, max_passes=RETROGRADE_MAX_PASSES):
+    #negamax value of every node of CSR graph in vectorized passes: node with children gets best of its
+    #children's values negated (mate one ply longer, as in alpha-beta), leaves keep their score.
+    #Nodes with children start as repetition draws (draw_scores: one value or one per node), so cycle
+    #that no side wants to leave stays draw like on_path repetition of alpha-beta.
+    #Each pass moves values one ply up, returns values, passes and nodes that still changed after
+    #max_passes (cycles of ever longer mates), those are set to draw
+    offsets = np.asarray(offsets, dtype=np.int64)
+    children = np.asarray(children, dtype=np.int64)
+    values = np.array(leaf_scores, dtype=np.int64)
+    inner = np.flatnonzero(offsets[1:]>offsets[:-1])
+    #segments of empty nodes have no length, so reduceat over starts of the others covers each node's edges
+    starts = offsets[inner]
+    draws = np.broadcast_to(np.asarray(draw_scores, dtype=np.int64), values.shape)[inner]
+    values[inner] = draws
+    passes = 0
+    unstable = inner[:0]
+    while len(inner):
+        scores = -values[children]
+        scores -= scores>mate_score - 1000
+        best = np.maximum.reduceat(scores, starts)
+        changed = best!=values[inner]
+        passes += 1
+        if not changed.any(): break
+        values[inner] = best
+        if passes>=max_passes:
+            unstable = inner[changed]
+            values[unstable] = draws[changed]
+            break
+    return values, passes, unstable
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 import time, sys, os
-import chess.uci
+import chess.uci, chess.polyglot, chess.syzygy
 import sqlite3
+import queue, threading
+import concurrent.futures, contextlib
+import heapq
+from metrics import Metrics
 
 BREAK_SEARCH = "break_search.flag"
 BEST_MOVE_ONLY = True
@@ -16,14 +20,55 @@ else:
 stockfish7_id = 1
 asmfish_id = 2
 brainfish_id = 3
+syzygy_id = 4
 db_name = "chess.db"
+ENGINE_COUNT = 1
+#positions with few pieces are probed from syzygy tables instead of engine search
+SYZYGY_FLAG = True
+SYZYGY_PATH = "/usr/games/syzygy"
+SYZYGY_MAX_PIECES = 7
+SYZYGY_WIN_SCORE = 20000 #minus distance to zeroing, cursed wins and blessed losses are draws
+SYZYGY_PV_PLIES = 10
+REPLAY_FLAG = False #engines answer from log_index.py index of old engine logs when possible
+if REPLAY_FLAG: stockfish_script = "stockfish_replay"
+else: stockfish_script = "stockfish_log_time"
+SLEEP_POLL_FLAG = False #old 0.1ms polling, only for comparing driver cpu usage
+#one MultiPV search of parent scores all children instead of one search per child,
+#it gets MULTIPV_BUDGET_FACTOR*children times the budget of one child search
+MULTIPV_FLAG = False
+MULTIPV_BUDGET_FACTOR = 1.0
+#engine results by (position hash, program_id, nodes2search), reused for same or smaller budget
+ENGINE_CACHE_FLAG = False #MultiPV searches are not cached
+ENGINE_CACHE_MAX_ENTRIES = 10**6
+ENGINE_CACHE_EVICT_INTERVAL = 1000
+WRITER_BATCH_SIZE = 1000
+WRITER_BATCH_SECONDS = 5.0
 
+#timers, counters and engine nps/tbhits histograms to log/*.jsonl and log/<program>.prom (metrics.py)
+METRICS_FLAG = False
+metrics = Metrics(METRICS_FLAG)
+
+PROGRESS_INTERVAL = 0.1 #seconds between progress lines of one engine, 0 shows every info line
 COUNTER_END = chr(27) + "[K\r"
-POS, FEN, PLY, MOVES, DEPTH, SELDEPTH, SCORE_TYPE, SCORE, NODES, TBHITS, TIME, PV, PROGRAM_ID = range(13)
+POS, FEN, PLY, MOVES, DEPTH, SELDEPTH, SCORE_TYPE, SCORE, NODES, TBHITS, TIME, PV, PROGRAM_ID, HASH, BUDGET = range(15)
+ANALYSIS_COLUMNS = ("pos", "fen", "ply", "moves", "depth", "seldepth", "score_type", "score", "nodes", "tbhits", "time", "pv", "program_id", "hash", "budget")
+#same position analysed again: latest analysis replaces the old row unless old one had bigger budget
+#(nodes2search of the search, NULL for rows from before budgets were stored)
+UPSERT_ANALYSIS = "INSERT INTO analysis(%s) VALUES(%s) ON CONFLICT(pos) DO UPDATE SET %s WHERE IFNULL(excluded.budget, 0)>=IFNULL(analysis.budget, 0)" % (
+    ", ".join(ANALYSIS_COLUMNS), ",".join(["?"]*len(ANALYSIS_COLUMNS)),
+    ", ".join(["%s=excluded.%s" % (col, col) for col in ANALYSIS_COLUMNS[1:]]))
+INSERT_LINK = "INSERT OR IGNORE INTO link VALUES(?,?,?)"
+INSERT_LINK_MISSING = "INSERT INTO link_missing VALUES(?,?)"
 
 def fen2key(fen):
     return " ".join(fen.split()[:-2])
 
+def board2hash(board):
+    #polyglot zobrist hash as signed 64 bit to fit SQLite INTEGER
+    h = chess.polyglot.zobrist_hash(board)
+    if h >= 2**63: h -= 2**64
+    return h
+
 def get_time_str():
     return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time()))
 
@@ -50,9 +95,15 @@ def board2san(start_fen, board0):
         board.push(move)
     return " ".join(["{0}{1}".format(num, s) for (num, s) in zip(move_numbers, san)])
 
-def str_info(start_fen, board, info):
-    existing_moves = board2san(start_fen, board)
+def str_info(start_fen, board, info, existing_moves=None, san_pv=True):
+    #mate/stalemate position has only depth and score
+    #existing_moves: board2san of board if already known, san_pv=False leaves PV in UCI for progress lines
+    pv = info["pv"].get(1, [])
+    if existing_moves==None:
+        existing_moves = board2san(start_fen, board)
     if existing_moves: existing_moves += " "
+    if san_pv: pv = board.variation_san(pv)
+    else: pv = " ".join(map(str, pv))
     score = info["score"][1]
     if score.cp!=None:
         score = "%.2f" % (score.cp/100,)
@@ -61,57 +112,431 @@ def str_info(start_fen, board, info):
     if "seldepth" in info:
         s = "%s%i/%i %s n:%s tb:%s %.3fs %s" % (
             existing_moves, info["depth"], info["seldepth"],
-            score, info["nodes"], info["tbhits"], info["time"]/1000,
-            board.variation_san(info["pv"][1]))
+            score, info.get("nodes", 0), info.get("tbhits", 0), info.get("time", 0)/1000,
+            pv)
     else:
         s = "%s%i %s n:%s tb:%s %.3fs %s" % (
             existing_moves, info["depth"],
-            score, info["nodes"], info["tbhits"], info["time"]/1000,
-            board.variation_san(info["pv"][1]))
+            score, info.get("nodes", 0), info.get("tbhits", 0), info.get("time", 0)/1000,
+            pv)
     return s
 
 def create_empty_chess_db(db_name):
     db = sqlite3.connect(db_name)
     c = db.cursor()
     c.execute('''CREATE TABLE analysis
-             (pos TEXT KEY, fen TEXT, ply INTEGER, moves TEXT, depth INTEGER, seldepth INTEGER, score_type TEXT, score INTEGER, nodes INTEGER, tbhits INTEGER, time INTEGER, pv TEXT, program_id INTEGER)''')
-    c.execute("CREATE INDEX analysis_pos_index ON analysis (pos)")
+             (pos TEXT KEY, fen TEXT, ply INTEGER, moves TEXT, depth INTEGER, seldepth INTEGER, score_type TEXT, score INTEGER, nodes INTEGER, tbhits INTEGER, time INTEGER, pv TEXT, program_id INTEGER, hash INTEGER, budget INTEGER)''')
+    c.execute("CREATE UNIQUE INDEX analysis_pos_unique ON analysis (pos)")
+    c.execute("CREATE INDEX analysis_hash_index ON analysis (hash)")
+    create_link_table(c)
+    create_plan_table(c)
+    create_cache_table(c)
+    create_change_table(c)
+    create_value_table(c)
     return db, c
 
+def create_link_table(c):
+    #undo_search.py position graph: hash1 -> hash2 by move
+    c.execute("CREATE TABLE IF NOT EXISTS link (hash1 INTEGER, hash2 INTEGER, move TEXT)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS link_index ON link (hash1, hash2)")
+    #search_depth.py runs that left parents without links, undo_search.py rebuilds links while there are rows
+    c.execute("CREATE TABLE IF NOT EXISTS link_missing (ply INTEGER, cp_limit INTEGER)")
+
+def create_cache_table(c):
+    #EngineCache, one row per position and program with the biggest budget searched
+    c.execute("CREATE TABLE IF NOT EXISTS engine_cache (hash INTEGER, program_id INTEGER, budget INTEGER, depth INTEGER, seldepth INTEGER, score_type TEXT, score INTEGER, nodes INTEGER, tbhits INTEGER, time INTEGER, pv TEXT, last_used INTEGER)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS engine_cache_index ON engine_cache (hash, program_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS engine_cache_used_index ON engine_cache (last_used)")
+
+def create_plan_table(c):
+    #search_depth.py children still to analyse, removed when ply is done
+    c.execute("CREATE TABLE IF NOT EXISTS plan (ply INTEGER, cp_limit INTEGER, priority INTEGER, seq INTEGER, pos TEXT, fen TEXT, moves TEXT, move TEXT)")
+
+def create_change_table(c):
+    #keys of analysis rows written since undo_search.py export_snapshot, AUTOINCREMENT so seq never goes back
+    c.execute("CREATE TABLE IF NOT EXISTS analysis_change (seq INTEGER PRIMARY KEY AUTOINCREMENT, pos TEXT)")
+
+def create_change_triggers(c):
+    #installed by undo_search.py only while there is a snapshot to keep up to date
+    c.execute("CREATE TRIGGER IF NOT EXISTS analysis_insert_change AFTER INSERT ON analysis BEGIN INSERT INTO analysis_change(pos) VALUES(new.pos); END")
+    c.execute("CREATE TRIGGER IF NOT EXISTS analysis_update_change AFTER UPDATE ON analysis BEGIN INSERT INTO analysis_change(pos) VALUES(new.pos); END")
+
+def drop_change_triggers(c):
+    c.execute("DROP TRIGGER IF EXISTS analysis_insert_change")
+    c.execute("DROP TRIGGER IF EXISTS analysis_update_change")
+
+def prune_change_table(c):
+    #snapshot start needs only last change of each position, keeps table at most one row per position
+    #when chess.db is written by search_depth.py only and no snapshot is exported
+    c.execute("DELETE FROM analysis_change WHERE seq NOT IN (SELECT MAX(seq) FROM analysis_change GROUP BY pos)")
+
+def create_value_table(c):
+    #undo_search.py retrograde: minimax value of every position, join with analysis on hash
+    c.execute("CREATE TABLE IF NOT EXISTS node_value (hash INTEGER PRIMARY KEY, value INTEGER)")
+
+def migrate_chess_db(db_name):
+    db = sqlite3.connect(db_name, 60.0)
+    c = db.cursor()
+    columns = [row[1] for row in c.execute("PRAGMA table_info(analysis)")]
+    if "hash" not in columns:
+        c.execute("ALTER TABLE analysis ADD COLUMN hash INTEGER")
+    if "budget" not in columns:
+        c.execute("ALTER TABLE analysis ADD COLUMN budget INTEGER")
+    rows = c.execute("SELECT rowid, pos FROM analysis WHERE hash IS NULL").fetchall()
+    if rows:
+        t0 = time.time()
+        print("adding hash to %i analysis rows..." % (len(rows),))
+        c.executemany("UPDATE analysis SET hash=? WHERE rowid=?",
+                      ((board2hash(chess.Board(pos + " 0 1")), rowid) for rowid, pos in rows))
+        print("hashes added in %.3fs" % (time.time() - t0,))
+    c.execute("CREATE INDEX IF NOT EXISTS analysis_hash_index ON analysis (hash)")
+    indexes = [row[1] for row in c.execute("PRAGMA index_list(analysis)")]
+    if "analysis_pos_unique" not in indexes:
+        #keep latest row of each position, same row wins as when loading positions
+        t0 = time.time()
+        c.execute("DELETE FROM analysis WHERE rowid NOT IN (SELECT MAX(rowid) FROM analysis GROUP BY pos)")
+        print("%i duplicate analysis rows removed in %.3fs" % (c.rowcount, time.time() - t0))
+        c.execute("CREATE UNIQUE INDEX analysis_pos_unique ON analysis (pos)")
+        c.execute("DROP INDEX IF EXISTS analysis_pos_index")
+    create_link_table(c)
+    create_plan_table(c)
+    create_cache_table(c)
+    create_change_table(c)
+    create_value_table(c)
+    db.commit()
+    db.close()
+
 def create_chess_db():
-    if os.path.exists(db_name): return
+    if os.path.exists(db_name):
+        migrate_chess_db(db_name)
+        return
     db, c = create_empty_chess_db(db_name)
+    board = chess.Board(start_position)
     if standard_position_flag:
-        c.execute("INSERT INTO analysis(pos, fen, ply, moves, depth, seldepth, score_type, score, nodes, tbhits, time, pv, program_id) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                  (fen2key(start_position), start_position, 0, "", 50, 65, "cp", 15, 432633504141, 102, 402232934, "e2e4 e7e6 d2d4 d7d5 b1d2 f8e7 c2c3 c7c5 d4c5 g8f6 e4d5 d8d5 g1f3 d5c5 f1d3 e8g8 e1g1 b8d7 f1e1 c5c7 d2e4 b7b6 c1g5 c8b7 g5h4 c7d8 a2a4 h7h6 d3c2 a7a5 e4f6 d7f6 f3e5 e7c5 e5g4 d8d1 g4f6 g7f6 a1d1 g8g7 d1d7 b7c6 d7c7 f8c8 c7c6 c8c6 c2e4 c6c8 h4g3 c8d8 e4a8 d8a8 e1d1", stockfish7_id))
+        c.execute("INSERT INTO analysis(pos, fen, ply, moves, depth, seldepth, score_type, score, nodes, tbhits, time, pv, program_id, hash) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                  (fen2key(start_position), start_position, 0, "", 50, 65, "cp", 15, 432633504141, 102, 402232934, "e2e4 e7e6 d2d4 d7d5 b1d2 f8e7 c2c3 c7c5 d4c5 g8f6 e4d5 d8d5 g1f3 d5c5 f1d3 e8g8 e1g1 b8d7 f1e1 c5c7 d2e4 b7b6 c1g5 c8b7 g5h4 c7d8 a2a4 h7h6 d3c2 a7a5 e4f6 d7f6 f3e5 e7c5 e5g4 d8d1 g4f6 g7f6 a1d1 g8g7 d1d7 b7c6 d7c7 f8c8 c7c6 c8c6 c2e4 c6c8 h4g3 c8d8 e4a8 d8a8 e1d1", stockfish7_id, board2hash(board)))
     else:
-        c.execute("INSERT INTO analysis(pos, fen, ply, moves, depth, seldepth, score_type, score, nodes, tbhits, time, pv, program_id) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                  (fen2key(start_position), start_position, 0, "", 1, 1, "cp", 3000, 1, 0, 0, "e2e4", stockfish7_id))
+        c.execute("INSERT INTO analysis(pos, fen, ply, moves, depth, seldepth, score_type, score, nodes, tbhits, time, pv, program_id, hash) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                  (fen2key(start_position), start_position, 0, "", 1, 1, "cp", 3000, 1, 0, 0, "e2e4", stockfish7_id, board2hash(board)))
     db.commit()
     db.close()
 
+def driver_cpu_str(cpu_time, positions):
+    if SLEEP_POLL_FLAG: wait_s = "sleep poll"
+    else: wait_s = "event wait"
+    return "driver cpu (%s): %.3fs, %.2fms/position" % (wait_s, cpu_time, cpu_time*1000/max(positions, 1))
+
 class Result: pass
 
+def count_pieces(board):
+    count = 0
+    for color in chess.COLORS:
+        for piece_type in chess.PIECE_TYPES:
+            count += len(board.pieces(piece_type, color))
+    return count
+
+class Tablebase:
+    def __init__(self, path=SYZYGY_PATH):
+        self.tablebase = None
+        self.probes = 0
+        if SYZYGY_FLAG and os.path.isdir(path):
+            self.tablebase = chess.syzygy.open_tablebases(path)
+
+    def covers(self, board):
+        return self.tablebase!=None and not board.castling_rights and count_pieces(board)<=SYZYGY_MAX_PIECES
+
+    def probe(self, board):
+        #engine like Result with program_id, None if tables are missing
+        if not self.covers(board): return None
+        board = board.copy()
+        result = Result()
+        try:
+            if board.is_checkmate():
+                result.score_type = "mate"
+                result.score = 0
+            else:
+                wdl = self.tablebase.probe_wdl(board)
+                dtz = abs(self.tablebase.probe_dtz(board))
+                result.score_type = "cp"
+                if wdl==2: result.score = SYZYGY_WIN_SCORE - dtz
+                elif wdl==-2: result.score = -SYZYGY_WIN_SCORE + dtz
+                else: result.score = 0
+            pv = []
+            for i in range(SYZYGY_PV_PLIES):
+                move = self.best_move(board)
+                if move==None: break
+                pv.append(str(move))
+                board.push(move)
+        except KeyError:
+            return None
+        self.probes += 1
+        metrics.count("tablebase_probes")
+        result.depth = 127
+        result.seldepth = 0
+        result.nodes = 0
+        result.tbhits = 1
+        result.time = 0
+        result.pv = " ".join(pv)
+        result.program_id = syzygy_id
+        return result
+
+    def best_move(self, board):
+        #best wdl, winning side prefers zeroing moves and short dtz, losing side long dtz
+        best_key = None
+        best_move = None
+        for move in board.generate_legal_moves():
+            zeroing = board.is_zeroing(move)
+            board.push(move)
+            if board.is_checkmate():
+                key = (3, 0)
+            else:
+                wdl = -self.tablebase.probe_wdl(board)
+                dtz = abs(self.tablebase.probe_dtz(board))
+                if wdl>0: key = (wdl, 10**6 if zeroing else -dtz)
+                elif wdl<0: key = (wdl, dtz)
+                else: key = (wdl, 0)
+            board.pop()
+            if best_key==None or key>best_key:
+                best_key = key
+                best_move = move
+        return best_move
+
+    def probe_future(self, board, start_fen, moves):
+        #Analysis.search_pos like future, so tablebase positions go through same pending path
+        result = self.probe(board)
+        if result==None: return None
+        future = concurrent.futures.Future()
+        future.set_result([(board, start_fen, moves, result)])
+        return future
+
+def multipv_results(board, result):
+    #MultiPV lines of parent search as child results: score from child side, PV without first move,
+    #nodes/tbhits/time split evenly, lines without continuation are left for a child search
+    lines = max(len(result.lines), 1)
+    children = {}
+    for score, pv in result.lines.values():
+        if len(pv)<2: continue
+        child = Result()
+        if score.cp!=None:
+            child.score_type = "cp"
+            child.score = -score.cp
+        else:
+            child.score_type = "mate"
+            if score.mate>0: child.score = -(score.mate - 1)
+            else: child.score = -score.mate
+        child.depth = max(result.depth - 1, 0)
+        child.seldepth = max(result.seldepth - 1, 0)
+        child.nodes = result.nodes//lines
+        child.tbhits = result.tbhits//lines
+        child.time = result.time//lines
+        child.pv = " ".join(map(str, pv[1:]))
+        children[pv[0]] = child
+    return children
+
+class EngineCache:
+    #lookups are done from engine pool threads with own connection, writes go through DBWriter
+    def __init__(self, db_name, writer, max_entries=ENGINE_CACHE_MAX_ENTRIES):
+        self.db = sqlite3.connect(db_name, 60.0, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.writer = writer
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+
+    def get(self, board, program_id, budget):
+        h = board2hash(board)
+        with self.lock:
+            row = self.db.execute("SELECT depth, seldepth, score_type, score, nodes, tbhits, time, pv FROM engine_cache WHERE hash=? AND program_id=? AND budget>=?",
+                                  (h, program_id, budget)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.count("engine_cache_misses")
+                return None
+            self.hits += 1
+        metrics.count("engine_cache_hits")
+        self.writer.put("UPDATE engine_cache SET last_used=? WHERE hash=? AND program_id=?", [(int(time.time()), h, program_id)])
+        result = Result()
+        result.depth, result.seldepth, result.score_type, result.score, result.nodes, result.tbhits, result.time, result.pv = row
+        return result
+
+    def put(self, board, program_id, budget, result):
+        if not hasattr(result, "score_type"): return
+        self.writer.put("INSERT INTO engine_cache VALUES(?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT(hash, program_id) DO UPDATE SET budget=excluded.budget, depth=excluded.depth, seldepth=excluded.seldepth, score_type=excluded.score_type, score=excluded.score, nodes=excluded.nodes, tbhits=excluded.tbhits, time=excluded.time, pv=excluded.pv, last_used=excluded.last_used WHERE excluded.budget>=engine_cache.budget",
+                        [(board2hash(board), program_id, budget, result.depth, result.seldepth, result.score_type, result.score,
+                          result.nodes, result.tbhits, result.time, result.pv, int(time.time()))])
+        with self.lock:
+            self.puts += 1
+            evict = self.puts%ENGINE_CACHE_EVICT_INTERVAL==0
+        if evict:
+            self.writer.put("DELETE FROM engine_cache WHERE rowid IN (SELECT rowid FROM engine_cache ORDER BY last_used LIMIT max(0, (SELECT COUNT(*) FROM engine_cache) - ?))",
+                            [(self.max_entries,)])
+
+    def search(self, worker, program_id, budget, log, start_fen, board, count_info_prefix, **go_args):
+        #worker.analyse unless cache has at least same budget result
+        if ENGINE_CACHE_FLAG:
+            result = self.get(board, program_id, budget)
+            if result:
+                log.print_s("%s: cached %s %s %s" % (count_info_prefix, result.score_type, result.score, result.pv))
+                return result
+        result = worker.analyse(log, start_fen, board, count_info_prefix, nodes2search=budget, **go_args)
+        if ENGINE_CACHE_FLAG:
+            self.put(board, program_id, budget, result)
+        return result
+
+    def stats_str(self):
+        return "engine cache: %i hits, %i misses" % (self.hits, self.misses)
+
+class DBWriter:
+    #all analysis and link writes go through one thread with its own connection:
+    #rows are committed in batches of WRITER_BATCH_SIZE rows or after WRITER_BATCH_SECONDS,
+    #so engines never wait for fsync and crash loses at most last batch.
+    #Failed statement or commit loses only its own rows, it is logged and first error is raised by close.
+    #When thread could not open db or stopped, put/commit/sync/close raise instead of queueing or waiting
+    def __init__(self, db_name, batch_size=WRITER_BATCH_SIZE, batch_seconds=WRITER_BATCH_SECONDS):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.queue = queue.Queue()
+        self.log = None #Log for errors, print if not set
+        self.error = None
+        self.failed_rows = 0
+        self.rows = 0
+        self.commits = 0
+        self.put_count = 0 #statements queued, set by caller thread
+        self.done_count = 0 #statements committed or lost, set by writer thread
+        #journal mode is stored in db file, switched here so errors reach caller and writer
+        #thread never needs the exclusive lock for it
+        db = sqlite3.connect(db_name, 60.0)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.close()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def check_alive(self):
+        if not self.thread.is_alive():
+            raise self.error or RuntimeError("db writer is closed")
+
+    def put(self, statement, rows):
+        if rows:
+            self.check_alive()
+            self.put_count += 1
+            self.queue.put((statement, rows))
+
+    def commit(self):
+        #asynchronous, commits whatever is queued before it
+        self.check_alive()
+        self.queue.put(("commit", None))
+
+    def sync(self):
+        self.check_alive()
+        done = threading.Event()
+        self.queue.put(("sync", done))
+        while not done.wait(1.0):
+            self.check_alive()
+        if self.error: raise self.error
+
+    def close(self):
+        #second close only raises error again
+        if self.thread.is_alive():
+            self.queue.put(("close", None))
+            self.thread.join()
+        if self.error: raise self.error
+
+    def run(self):
+        #statement strings are reused, so sqlite3 statement cache keeps them prepared
+        try:
+            db = sqlite3.connect(self.db_name, 60.0)
+            db.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.Error as e:
+            lost = 0
+            while not self.queue.empty():
+                statement, rows = self.queue.get()
+                if statement not in ("commit", "sync", "close"):
+                    lost += len(rows)
+                    self.done_count += 1
+            self.report(e, "connection, all %i queued rows" % (lost,), lost)
+            return
+        c = db.cursor()
+        batch_rows = 0
+        batch_statements = 0
+        batch_t0 = None
+        while True:
+            if batch_rows:
+                timeout = max(batch_t0 + self.batch_seconds - time.time(), 0)
+            else:
+                timeout = None
+            try:
+                statement, rows = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                statement, rows = "commit", None
+            if statement in ("commit", "sync", "close"):
+                if batch_rows:
+                    self.commit_batch(db, batch_rows)
+                self.done_count += batch_statements
+                batch_rows = batch_statements = 0
+                if statement=="sync": rows.set()
+                elif statement=="close": break
+                continue
+            batch_statements += 1
+            try:
+                c.executemany(statement, rows)
+            except sqlite3.Error as e:
+                self.report(e, "%i rows of %s" % (len(rows), statement.split("(")[0]), len(rows))
+                continue
+            self.rows += len(rows)
+            if not batch_rows: batch_t0 = time.time()
+            batch_rows += len(rows)
+            if batch_rows>=self.batch_size:
+                self.commit_batch(db, batch_rows)
+                self.done_count += batch_statements
+                batch_rows = batch_statements = 0
+        db.close()
+
+    def report(self, e, what, rows):
+        if self.error is None: self.error = e
+        self.failed_rows += rows
+        s = "db writer: %s lost: %s" % (what, e)
+        if self.log: self.log.print_s(s)
+        else: print(s)
+
+    def commit_batch(self, db, batch_rows):
+        t0 = time.perf_counter()
+        try:
+            db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            self.report(e, "batch of %i rows" % (batch_rows,), batch_rows)
+            return
+        self.commits += 1
+        if metrics.enabled:
+            metrics.add_time("db_commit", time.perf_counter() - t0)
+            metrics.count("db_rows_committed", batch_rows)
+
 class Log:
     def __init__(self, basename):
         if not os.path.exists("log"): os.mkdir("log")
         filename = "log/%s_%s.log" % (basename, get_time_str())
         self.fp = open(filename, "a")
         self.last_counter = ""
+        self.lock = threading.Lock()
         self.print_s(filename)
 
     def write_counter(self, s):
-        self.last_counter = s
-        sys.stderr.write(s[:236] + COUNTER_END)
+        #called from engine threads, same lock as print_s
+        with self.lock:
+            self.last_counter = s
+            sys.stderr.write(s[:236] + COUNTER_END)
 
     def print_s(self, s=""):
-        if self.last_counter:
-            self.fp.write(self.last_counter)
-            sys.stderr.write(self.last_counter + COUNTER_END)
-            self.last_counter = ""
-        self.fp.write(s + "\n")
-        print(s)
-        self.fp.flush()
+        with self.lock:
+            if self.last_counter:
+                self.fp.write(self.last_counter)
+                sys.stderr.write(self.last_counter + COUNTER_END)
+                self.last_counter = ""
+            self.fp.write(s + "\n")
+            print(s)
+            self.fp.flush()
 
     def close(self):
         self.print_s()
@@ -121,27 +546,64 @@ class NodeHandler(chess.uci.InfoHandler):
     def __init__(self, nodes2search):
         super(NodeHandler, self).__init__()
         self.stop_flag = False
+        self.stop_event = threading.Event()
         self.nodes2search = nodes2search
+        self.nodes_limit = nodes2search
+        self.multipv_lines = 1
         self.result = Result()
+        self.prefix_san = None
+        self.progress_time = 0
+        self.progress_pending = False
 
-    def new_board(self, start_fen, board, count_info_prefix):
+    def new_board(self, start_fen, board, count_info_prefix, multipv=1, nodes2search=None):
+        #nodes2search: budget of this search instead of the engine's
+        if nodes2search is None: nodes2search = self.nodes2search
         self.start_fen = start_fen
         self.board = board
         self.count_info_prefix = count_info_prefix
+        self.multipv_lines = multipv
+        if multipv>1:
+            self.nodes_limit = nodes2search*multipv*MULTIPV_BUDGET_FACTOR
+        else:
+            self.nodes_limit = nodes2search
         self.stop_flag = False
+        self.stop_event.clear()
+        self.result = Result()
+        self.prefix_san = None
+        self.progress_pending = False
 
     def on_bestmove(self, bestmove, ponder):
-        if 1 not in self.info["pv"]:
+        if 1 not in self.info["pv"] and bestmove:
             self.info["pv"][1] = [bestmove]
             if ponder: self.info["pv"][1].append(ponder)
+        if self.progress_pending and not self.stop_flag:
+            #search ended by movetime, last info line was only a throttled progress line
+            self.write_info()
         self.break_search()
 
+    def write_info(self, final=True):
+        #SAN of moves to board is computed once per board, PV in SAN only for final line
+        if self.prefix_san==None:
+            self.prefix_san = board2san(self.start_fen, self.board)
+        self.log.write_counter(self.count_info_prefix + ": " + str_info(self.start_fen, self.board, self.info, self.prefix_san, final))
+
     def break_search(self):
         self.result.seldepth = self.info.get("seldepth", 0)
         self.result.tbhits = self.info.get("tbhits", 0)
         self.result.time = self.info.get("time", 0)
-        self.result.pv = " ".join(map(str, self.info["pv"][1]))
+        self.result.pv = " ".join(map(str, self.info["pv"].get(1, [])))
+        if self.multipv_lines>1:
+            self.result.lines = {k: (self.info["score"][k], list(self.info["pv"][k]))
+                                 for k in self.info["pv"] if k in self.info["score"]}
         self.stop_flag = True
+        self.stop_event.set()
+
+    def wait(self):
+        if SLEEP_POLL_FLAG:
+            while not self.stop_flag:
+                time.sleep(0.0001)
+        else:
+            self.stop_event.wait()
                 
     def post_info(self):
         # Called whenever a complete *info* line has been processed.
@@ -156,29 +618,99 @@ class NodeHandler(chess.uci.InfoHandler):
                 self.result.score_type = "mate"
                 self.result.score = score.mate
             self.result.depth = self.info["depth"]
-            self.result.nodes = self.info["nodes"]
-            break_search = self.result.nodes>self.nodes2search or self.result.score_type=="mate" or self.result.depth>=127
-            if break_search or self.result.nodes>=10000:
-                info_str = self.count_info_prefix + ": " + str_info(self.start_fen, self.board, self.info)
-                self.log.write_counter(info_str)
+            self.result.nodes = self.info.get("nodes", 0)
+            if self.multipv_lines>1:
+                #lines of one iteration come in multipv order, stop only after last one
+                if self.info.get("multipv", 1)<self.multipv_lines: return
+                break_search = self.result.nodes>self.nodes_limit or self.result.depth>=127
+            else:
+                break_search = self.result.nodes>self.nodes_limit or self.result.score_type=="mate" or self.result.depth>=127
             if break_search:
+                self.write_info()
                 self.break_search()
+            elif self.result.nodes>=10000:
+                self.progress_pending = True
+                t = time.time()
+                if t>=self.progress_time:
+                    self.progress_time = t + PROGRESS_INTERVAL
+                    self.write_info(False)
+
+class EngineWorker:
+    def __init__(self, engine_script, nodes2search):
+        self.name = os.path.basename(engine_script)
+        self.engine = chess.uci.popen_engine(engine_script)
+        self.engine.uci()
+        self.info_handler = NodeHandler(nodes2search)
+        self.engine.info_handlers.append(self.info_handler)
+        self.engine.setoption({"Hash":1024, "SyzygyPath": "/usr/games/syzygy"})
+        self.multipv = 1
+        self.busy_seconds = 0.0 #time spent in analyse, for utilisation
+
+    @metrics.timed("engine_search")
+    def analyse(self, log, start_fen, board, count_info_prefix, wait_flag=True, multipv=1, nodes2search=None, **go_args):
+        if multipv!=self.multipv:
+            self.engine.setoption({"MultiPV": multipv})
+            self.multipv = multipv
+        t0 = time.time()
+        self.info_handler.log = log
+        self.info_handler.new_board(start_fen, board, count_info_prefix, multipv, nodes2search)
+        self.engine.position(board)
+        if wait_flag:
+            command = self.engine.go(async_callback=True, **go_args)
+            self.info_handler.wait()
+            self.engine.stop()
+            command.result()
+        else:
+            self.engine.go(**go_args)
+        self.busy_seconds += time.time() - t0
+        result = self.info_handler.result
+        if metrics.enabled:
+            metrics.observe_engine(self.name, getattr(result, "nodes", 0), getattr(result, "tbhits", 0), getattr(result, "time", 0))
+        return result
+
+class EnginePool:
+    #each engine process has its own NodeHandler, jobs get whichever engine is idle
+    def __init__(self, engine_script, engine_count, nodes2search):
+        self.engine_count = engine_count
+        self.workers = queue.Queue()
+        self.all_workers = [EngineWorker(engine_script, nodes2search) for i in range(engine_count)]
+        for worker in self.all_workers:
+            self.workers.put(worker)
+        self.executor = concurrent.futures.ThreadPoolExecutor(engine_count)
+
+    def submit(self, fn, *args):
+        return self.executor.submit(self.run_job, fn, *args)
+
+    def run_job(self, fn, *args):
+        with self.worker() as worker:
+            return fn(worker, *args)
+
+    def busy_seconds(self):
+        return sum(worker.busy_seconds for worker in self.all_workers)
+
+    @contextlib.contextmanager
+    def worker(self):
+        worker = self.workers.get()
+        try:
+            yield worker
+        finally:
+            self.workers.put(worker)
 
 class Analysis:
-    def __init__(self, nodes2search):
+    def __init__(self, nodes2search, engine_count=ENGINE_COUNT):
         create_chess_db()
         self.infinite_mode = True
         self.nodes2search = nodes2search
         self.commit_interval = max(10**8//nodes2search, 1)
         self.db = sqlite3.connect(db_name, 60.0)
         self.c = self.db.cursor()
+        self.writer = DBWriter(db_name, self.commit_interval)
+        self.cache = EngineCache(db_name, self.writer)
+        self.tablebase = Tablebase()
         self.existing = {pos: score_type for (pos, score_type) in self.c.execute("SELECT pos, score_type FROM analysis")}
         self.program_id = stockfish7_id
-        self.engine = chess.uci.popen_engine("stockfish_log_time")
-        self.engine.uci()
-        self.info_handler = NodeHandler(self.nodes2search)
-        self.engine.info_handlers.append(self.info_handler)
-        self.engine.setoption({"Hash":1024, "SyzygyPath": "/usr/games/syzygy"})
+        self.pool = EnginePool(stockfish_script, engine_count, self.nodes2search)
+        self.max_pending = 2*engine_count
 
     def analyse_pos(self, count_info_prefix, start_fen, moves):
         board = chess.Board(start_fen)
@@ -199,52 +731,150 @@ class Analysis:
 ##                        0, "",
 ##                        self.program_id))
 ##        return True, False
-        self.info_handler.new_board(start_fen, board, count_info_prefix)
-        self.engine.position(board)
+        #transpositions reached while this one is still searched are skipped too
+        self.existing[key] = "queued"
+        future = self.tablebase.probe_future(board, start_fen, moves)
+        if not future:
+            future = self.pool.submit(self.search_pos, count_info_prefix, start_fen, board, moves)
+        if metrics.enabled:
+            #submit until result, analyse_pos itself only queues the search
+            t0 = time.perf_counter()
+            future.add_done_callback(lambda future: metrics.add_time("analyse_pos", time.perf_counter() - t0))
+        return True, future
+
+    def analyse_children(self, count_info_prefix, start_fen, moves, board, legal_moves):
+        #MULTIPV_FLAG version of analyse_pos for all children of board, returns existing score types
+        #and future of one MultiPV search restricted to the missing children
+        missing = []
+        old = []
+        tb_results = []
+        for m in legal_moves:
+            board.push(m)
+            key = fen2key(board.fen())
+            if key in self.existing:
+                old.append(self.existing[key])
+            else:
+                self.existing[key] = "queued"
+                future = self.tablebase.probe_future(board.copy(), start_fen, moves + " " + str(m))
+                if future: tb_results.extend(future.result())
+                else: missing.append(m)
+            board.pop()
+        if old:
+            self.log.print_s("%s %s: already done: %i" % (count_info_prefix, moves, len(old)))
+        if not missing:
+            if not tb_results: return old, None
+            future = concurrent.futures.Future()
+            future.set_result(tb_results)
+            return old, future
+        return old, self.pool.submit(self.search_children, count_info_prefix, start_fen, board.copy(), moves, missing, tb_results)
 
+    def search_pos(self, worker, count_info_prefix, start_fen, board, moves):
         if self.infinite_mode:
-            command = self.engine.go(infinite=True, async_callback=True)
-            prev_nodes = nodes = 0
-            while not self.info_handler.stop_flag:
-                time.sleep(0.0001)
-            self.engine.stop()
-            res = command.result()
+            result = self.cache.search(worker, self.program_id, self.nodes2search, self.log, start_fen, board, count_info_prefix, infinite=True)
+        else:
+            result = self.cache.search(worker, self.program_id, self.nodes2search, self.log, start_fen, board, count_info_prefix, wait_flag=False, nodes=self.nodes2search)
+        return [(board, start_fen, moves, result)]
+
+    def search_children(self, worker, count_info_prefix, start_fen, board, moves, missing, tb_results=()):
+        if len(missing)==1:
+            children = {}
+        elif self.infinite_mode:
+            result = worker.analyse(self.log, start_fen, board, count_info_prefix, multipv=len(missing), searchmoves=missing, infinite=True)
+            children = multipv_results(board, result)
         else:
-            res = self.engine.go(nodes=self.nodes2search)
-        mate_found = self.info_handler.result.score_type=="mate"
+            nodes = int(self.nodes2search*len(missing)*MULTIPV_BUDGET_FACTOR)
+            result = worker.analyse(self.log, start_fen, board, count_info_prefix, wait_flag=False, multipv=len(missing), searchmoves=missing, nodes=nodes)
+            children = multipv_results(board, result)
+        results = list(tb_results)
+        for m in missing:
+            board2 = board.copy()
+            board2.push(m)
+            moves2 = moves + " " + str(m)
+            if m in children:
+                results.append((board2, start_fen, moves2, children[m]))
+            else:
+                results.extend(self.search_pos(worker, count_info_prefix + " " + str(m), start_fen, board2, moves2))
+        return results
+
+    def finish_pos(self, future):
         self.log.print_s()
-        self.store_result(board, start_fen, moves, self.info_handler.result)
-        return True, mate_found
+        for board, start_fen, moves, result in future.result():
+            self.store_result(board, start_fen, moves, result)
+            if result.score_type=="mate":
+                self.mate_count += 1
+            else:
+                self.new_pos += 1
+                if self.cp_limit!=None and result.score<self.cp_limit:
+                    self.cp_limit_count += 1
+            if (self.mate_count+self.new_pos)%self.commit_interval==0:
+                self.log.print_s()
+                self.log.print_s("committing...")
+                self.writer.commit()
+
+    def wait_pending(self, return_when=concurrent.futures.ALL_COMPLETED):
+        done, self.pending = concurrent.futures.wait(self.pending, return_when=return_when)
+        for future in done:
+            self.finish_pos(future)
         
     def store_result(self, board, start_fen, moves, info):
         pos = fen2key(board.fen())
         self.existing[pos] = "new " + info.score_type
-        self.c.execute("INSERT INTO analysis(pos, fen, ply, moves, depth, seldepth, score_type, score, nodes, tbhits, time, pv, program_id) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                       (pos, start_fen, len(moves.split()),
-                        moves, info.depth, info.seldepth,
-                        info.score_type, info.score, info.nodes, info.tbhits,
-                        info.time, info.pv,
-                        self.program_id))
+        self.writer.put(UPSERT_ANALYSIS,
+                        [(pos, start_fen, len(moves.split()),
+                          moves, info.depth, info.seldepth,
+                          info.score_type, info.score, info.nodes, info.tbhits,
+                          info.time, info.pv,
+                          getattr(info, "program_id", self.program_id), board2hash(board), self.nodes2search)])
 
-    def search_depth(self, ply_depth, cp_limit):
-        self.log = Log("search_depth%i_%i" % (ply_depth, self.nodes2search))
-        self.info_handler.log = self.log
+    def plan_children(self, ply_depth, cp_limit):
+        #children of ply_depth parents once each, known positions and transpositions dropped,
+        #ordered by parent score closeness to cp_limit (or 0), plan table lets break/resume
+        #continue without rescanning parents
+        plan = self.c.execute("SELECT priority, seq, pos, fen, moves, move FROM plan WHERE ply=? AND cp_limit IS ?", (ply_depth, cp_limit)).fetchall()
+        if plan:
+            self.log.print_s("resuming plan: %i children" % (len(plan),))
+        else:
+            t0 = time.time()
+            if cp_limit==None: target = 0
+            else: target = cp_limit
+            seen = set()
+            parent_count = 0
+            repeated = 0
+            for start_fen, moves2, board, score in self.plan_parents(ply_depth, cp_limit):
+                parent_count += 1
+                if board.is_game_over():
+                    input("game is over, should not happen! " + start_fen + " " + moves2)
+                    continue
+                priority = abs(score - target)
+                for m in board.generate_legal_moves():
+                    board.push(m)
+                    key = fen2key(board.fen())
+                    board.pop()
+                    if key in seen:
+                        repeated += 1
+                        continue
+                    seen.add(key)
+                    plan.append((priority, len(plan), key, start_fen, moves2, str(m)))
+            self.c.executemany("INSERT INTO plan VALUES(?,?,?,?,?,?,?,?)", ((ply_depth, cp_limit) + item for item in plan))
+            self.db.commit()
+            self.log.print_s("plan: %i parents, %i children, %i repeated in %.3fs" % (parent_count, len(plan), repeated, time.time() - t0))
+        old = []
+        heap = []
+        for item in plan:
+            if item[2] in self.existing:
+                old.append(self.existing[item[2]])
+            else:
+                heap.append(item)
+        heapq.heapify(heap)
+        return heap, old
+
+    def plan_parents(self, ply_depth, cp_limit):
+        #boards whose children plan_children searches
         if cp_limit==None:
-            res = self.c.execute("SELECT fen, moves, pv FROM analysis WHERE ply=? AND score_type='cp'", (ply_depth,)).fetchall()
+            parents = self.db.execute("SELECT fen, moves, pv, score FROM analysis WHERE ply=? AND score_type='cp'", (ply_depth,))
         else:
-            res = self.c.execute("SELECT fen, moves, pv FROM analysis WHERE ply=? AND score_type='cp' AND score<?", (ply_depth, cp_limit)).fetchall()
-        total_pos = len(res)
-        current_pos = 0
-        new_pos = 0
-        old_mate = 0
-        old_pos = 0
-        mate_count = 0
-        cp_limit_count = 0
-        break_flag = False
-        for start_fen, moves, pv in res:
-            if break_flag:
-                break
-            current_pos += 1
+            parents = self.db.execute("SELECT fen, moves, pv, score FROM analysis WHERE ply=? AND score_type='cp' AND score<?", (ply_depth, cp_limit))
+        for start_fen, moves, pv, score in parents:
             board = chess.Board(start_fen)
             if BEST_MOVE_ONLY:
                 moves2 = moves + " " + pv.split()[0]
@@ -252,46 +882,117 @@ class Analysis:
                 moves2 = moves
             for m in moves2.split():
                 board.push_uci(m)
-            legal_moves = list(board.generate_legal_moves())
-            if board.is_game_over():
-                input("game is over, should not happen! " + start_fen + " " + moves2)
-                continue
-            i = 0
-            for m in legal_moves:
-                i += 1
-                moves3 = moves2 + " " + str(m)
-                if cp_limit==None:
-                    cp_limit_s = ""
-                else:
-                    cp_limit_s = "(<%i)" % cp_limit_count
-                count_info_prefix = "%i/%i %i/%i +%i%s(-%i-M%i)M%i D%s" % (current_pos, total_pos, i, len(legal_moves), new_pos, cp_limit_s, old_pos, old_mate, mate_count, len(moves.split()))
-                res, score_type = self.analyse_pos(count_info_prefix, start_fen, moves3)
-                if res:
-                    if score_type:
-                        mate_count += 1
+            yield start_fen, moves2, board, score
+
+    def store_links(self, ply_depth, cp_limit):
+        #link rows of planned parents in analysis whose children are all analysed, for undo_search.py.
+        #All legal moves are linked, also where undo_search.py ONE_SIDE_ONLY_FLAG rebuild_links links best move only.
+        #With BEST_MOVE_ONLY parent is position after best move, usually not analysed itself, so most parents
+        #get no links here; link_missing makes undo_search.py rebuild links from analysis table
+        links = []
+        parents = 0
+        linked = 0
+        for start_fen, moves2, board, score in self.plan_parents(ply_depth, cp_limit):
+            parents += 1
+            if fen2key(board.fen()) not in self.existing: continue
+            h = board2hash(board)
+            children = []
+            for m in board.generate_legal_moves():
+                board.push(m)
+                if fen2key(board.fen()) not in self.existing: break
+                children.append((h, board2hash(board), str(m)))
+                board.pop()
+            else:
+                links.extend(children)
+                linked += 1
+        self.writer.put(INSERT_LINK, links)
+        if linked<parents:
+            self.writer.put(INSERT_LINK_MISSING, [(ply_depth, cp_limit)])
+        return linked, parents
+
+    def search_depth(self, ply_depth, cp_limit):
+        try:
+            self.run_search_depth(ply_depth, cp_limit)
+        finally:
+            #queued rows are committed whatever ended the search
+            if self.writer.thread.is_alive(): self.writer.close()
+            metrics.close()
+
+    def run_search_depth(self, ply_depth, cp_limit):
+        self.log = Log("search_depth%i_%i" % (ply_depth, self.nodes2search))
+        self.writer.log = self.log
+        metrics.start("search_depth")
+        self.log.print_s("engines: %i" % (self.pool.engine_count,))
+        cpu0 = time.process_time()
+        self.cp_limit = cp_limit
+        heap, old = self.plan_children(ply_depth, cp_limit)
+        total_pos = len(heap)
+        current_pos = 0
+        self.new_pos = 0
+        old_mate = len([score_type for score_type in old if score_type.find('mate')>=0])
+        old_pos = len(old) - old_mate
+        self.mate_count = 0
+        self.cp_limit_count = 0
+        self.pending = set()
+        while heap:
+            priority, seq, key, start_fen, moves2, m = heapq.heappop(heap)
+            current_pos += 1
+            if cp_limit==None:
+                cp_limit_s = ""
+            else:
+                cp_limit_s = "(<%i)" % self.cp_limit_count
+            if MULTIPV_FLAG:
+                #children of same parent have same priority and consecutive seq
+                legal_moves = [chess.Move.from_uci(m)]
+                while heap and heap[0][3]==start_fen and heap[0][4]==moves2:
+                    legal_moves.append(chess.Move.from_uci(heapq.heappop(heap)[5]))
+                    current_pos += 1
+                board = chess.Board(start_fen)
+                for m in moves2.split():
+                    board.push_uci(m)
+                count_info_prefix = "%i/%i MultiPV%i +%i%s(-%i-M%i)M%i D%s" % (current_pos, total_pos, len(legal_moves), self.new_pos, cp_limit_s, old_pos, old_mate, self.mate_count, ply_depth)
+                old, future = self.analyse_children(count_info_prefix, start_fen, moves2, board, legal_moves)
+                for score_type in old:
+                    if score_type.find('mate')>=0:
+                        old_mate += 1
                     else:
-                        new_pos += 1
-                        if cp_limit!=None and self.info_handler.result.score<cp_limit:
-                            cp_limit_count += 1
-                    if (mate_count+new_pos)%self.commit_interval==0:
-                        self.log.print_s()
-                        self.log.print_s("committing...")
-                        self.db.commit()
-                else:
+                        old_pos += 1
+                res = future!=None
+            else:
+                count_info_prefix = "%i/%i +%i%s(-%i-M%i)M%i D%s" % (current_pos, total_pos, self.new_pos, cp_limit_s, old_pos, old_mate, self.mate_count, ply_depth)
+                res, future = self.analyse_pos(count_info_prefix, start_fen, moves2 + " " + m)
+                if not res:
+                    score_type = future
                     if score_type.find('mate')>=0:
                         old_mate += 1
                     else:
                         old_pos += 1
-                if os.path.exists(BREAK_SEARCH):
-                    os.remove(BREAK_SEARCH)
-                    break_flag = True
-                    break
+            if res:
+                self.pending.add(future)
+                if len(self.pending)>=self.max_pending:
+                    self.wait_pending(concurrent.futures.FIRST_COMPLETED)
+            if os.path.exists(BREAK_SEARCH):
+                os.remove(BREAK_SEARCH)
+                break
+        self.wait_pending()
+        linked, parents = self.store_links(ply_depth, cp_limit)
+        self.writer.close()
+        if not heap:
+            self.c.execute("DELETE FROM plan WHERE ply=? AND cp_limit IS ?", (ply_depth, cp_limit))
+            self.db.commit()
+        prune_change_table(self.c)
         self.db.commit()
         if cp_limit==None:
             cp_limit_s = ""
         else:
-            cp_limit_s = "(<%i:%i)" % (cp_limit, cp_limit_count)
-        self.log.print_s("new: %i%s, already: %i, already mate: %i, mate: %i" % (new_pos, cp_limit_s, old_pos, old_mate, mate_count))
+            cp_limit_s = "(<%i:%i)" % (cp_limit, self.cp_limit_count)
+        self.log.print_s("new: %i%s, already: %i, already mate: %i, mate: %i" % (self.new_pos, cp_limit_s, old_pos, old_mate, self.mate_count))
+        self.log.print_s(driver_cpu_str(time.process_time() - cpu0, self.new_pos + self.mate_count))
+        self.log.print_s("db writer: %i rows in %i commits, %i rows lost" % (self.writer.rows, self.writer.commits, self.writer.failed_rows))
+        self.log.print_s("links: %i of %i parents, others are linked by undo_search.py rebuild_links" % (linked, parents))
+        self.log.print_s(self.cache.stats_str())
+        self.log.print_s("tablebase probes: %i" % (self.tablebase.probes,))
+        metrics.close()
         self.log.close()
 
 if __name__=="__main__":
@@ -299,5 +1000,7 @@ if __name__=="__main__":
     nodes2search = int(sys.argv[2])
     if len(sys.argv)>3: cp_limit = int(sys.argv[3])
     else: cp_limit = None
-    an = Analysis(nodes2search)
+    if len(sys.argv)>4: engine_count = int(sys.argv[4])
+    else: engine_count = ENGINE_COUNT
+    an = Analysis(nodes2search, engine_count)
     an.search_depth(depth, cp_limit)
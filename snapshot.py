@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import os, mmap, struct
+from array import array
+
+#undo_search.py export_snapshot writes, UndoSearch maps it at startup instead of reading all rows:
+#header, node records (hash, budget, normalized score, best move code), link graph in CSR form
+#(offsets per node, child node and move code per edge), keys joined by newlines if keys are fen strings
+SNAPSHOT_MAGIC = b"UNDOSNAP"
+SNAPSHOT_VERSION = 2
+HEADER = struct.Struct("<8sIIqqqqq") #magic, version, zobrist keys, nodes, edges, analysis_change seq, link rowid, key bytes
+NODE = struct.Struct("<qqiH2x")
+
+def write_snapshot(filename, zobrist_keys, change_seq, link_rowid, nodes, offsets, children, moves, keys):
+    #nodes: (hash, budget, score, move code) tuples, keys: fen keys of nodes or None
+    if keys is None: key_bytes = b""
+    else: key_bytes = "\n".join(keys).encode()
+    tmp_name = filename + ".tmp"
+    with open(tmp_name, "wb") as fp:
+        fp.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, zobrist_keys, len(nodes), len(children), change_seq, link_rowid, len(key_bytes)))
+        for node in nodes:
+            fp.write(NODE.pack(*node))
+        fp.write(array("q", offsets).tobytes())
+        fp.write(array("i", children).tobytes())
+        fp.write(array("H", moves).tobytes())
+        fp.write(b"\0"*(-2*len(moves) % 8))
+        fp.write(key_bytes)
+    #readers never see half written snapshot
+    os.replace(tmp_name, filename)
+
+class Snapshot:
+    #raises ValueError for file of other format or version, arrays are views of the mapped file
+    def __init__(self, filename):
+        with open(filename, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm)<HEADER.size:
+            raise ValueError("%s: too short" % (filename,))
+        magic, version, zobrist_keys, self.node_count, self.edge_count, self.change_seq, self.link_rowid, key_bytes = HEADER.unpack_from(self.mm)
+        if magic!=SNAPSHOT_MAGIC or version!=SNAPSHOT_VERSION:
+            raise ValueError("%s: not a version %i snapshot" % (filename, SNAPSHOT_VERSION))
+        self.zobrist_keys = bool(zobrist_keys)
+        self.view = view = memoryview(self.mm)
+        i = HEADER.size
+        self.node_view = view[i:i + NODE.size*self.node_count]
+        i += NODE.size*self.node_count
+        self.offsets = view[i:i + 8*(self.node_count + 1)].cast("q")
+        i += 8*(self.node_count + 1)
+        self.children = view[i:i + 4*self.edge_count].cast("i")
+        i += 4*self.edge_count
+        self.moves = view[i:i + 2*self.edge_count].cast("H")
+        i += 2*self.edge_count + (-2*self.edge_count % 8)
+        self.key_view = view[i:i + key_bytes]
+        if i + key_bytes!=len(self.mm):
+            raise ValueError("%s: size does not match header" % (filename,))
+
+    def nodes(self):
+        return NODE.iter_unpack(self.node_view)
+
+    def keys(self):
+        #node keys, hashes for zobrist keys
+        if self.zobrist_keys:
+            return [h for h, budget, score, code in self.nodes()]
+        if not self.node_count: return []
+        return bytes(self.key_view).decode().split("\n")
+
+    def close(self):
+        for view in (self.node_view, self.offsets, self.children, self.moves, self.key_view, self.view):
+            view.release()
+        self.mm.close()
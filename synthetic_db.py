@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import sys, os, time, random
+from search_depth import *
+import undo_search
+
+#chess.db for benchmarks: random walks from start_position down the linked positions, the leaf
+#where a walk ends is expanded like undo_search.py does (all moves for UNDO_COLOR, PV move for other side)
+#branching: walk picks one of that many best scored children, small values give deep narrow trees
+
+def synthetic_value(row):
+    #score for ordering children like undo_search.py get_score
+    if row[SCORE_TYPE]=="mate":
+        if row[SCORE]<0: return -undo_search.MATE_SCORE - row[SCORE]
+        else: return undo_search.MATE_SCORE - row[SCORE]
+    return row[SCORE]
+
+def synthetic_row(r, board, pos, ply, moves):
+    legal_moves = list(board.generate_legal_moves())
+    pv = [str(r.choice(legal_moves))] if legal_moves else []
+    #mate scores only for real mates, they would end undo_search.py loop
+    score_type, score = "cp", int(r.gauss(0, 50))
+    if not legal_moves and board.is_check():
+        score_type, score = "mate", 0
+    elif not legal_moves:
+        score = 0
+    depth = r.randint(20, 30)
+    return [pos, start_position, ply, moves, depth, depth + r.randint(0, 10), score_type, score,
+            r.randint(10**6, 10**7), 0, r.randint(500, 5000), " ".join(pv), stockfish7_id, board2hash(board), None]
+
+def create_synthetic_db(positions, branching=3, seed=1):
+    r = random.Random(seed)
+    if os.path.exists(db_name):
+        raise ValueError("%s exists" % (db_name,))
+    db, c = create_empty_chess_db(db_name)
+    t0 = time.time()
+    board = chess.Board(start_position)
+    root = fen2key(board.fen())
+    rows = {root: synthetic_row(r, board, root, 0, "")}
+    link_to = {}
+    walk_children = {}
+    links = []
+    failed_walks = 0
+    while len(rows)<positions and failed_walks<1000:
+        board = chess.Board(start_position)
+        pos = root
+        moves = []
+        while pos in link_to:
+            pos2 = r.choice(walk_children[pos])
+            board.push_uci(link_to[pos][pos2])
+            moves.append(link_to[pos][pos2])
+            pos = pos2
+        if board.is_game_over():
+            #walk ended in mate or stalemate, stop when tree has no other leaves
+            failed_walks += 1
+            continue
+        failed_walks = 0
+        if board.turn==undo_search.UNDO_COLOR or not undo_search.ONE_SIDE_ONLY_FLAG:
+            expand_moves = list(board.generate_legal_moves())
+        else:
+            expand_moves = [chess.Move.from_uci(rows[pos][PV].split()[0])]
+        link_to[pos] = {}
+        for m in expand_moves:
+            board.push(m)
+            pos2 = fen2key(board.fen())
+            if pos2 not in rows:
+                rows[pos2] = synthetic_row(r, board, pos2, len(moves) + 1, " ".join(moves + [str(m)]))
+            board.pop()
+            link_to[pos][pos2] = str(m)
+            links.append((rows[pos][HASH], rows[pos2][HASH], str(m)))
+        walk_children[pos] = sorted(link_to[pos], key=lambda pos2: synthetic_value(rows[pos2]))[:branching]
+    c.executemany("INSERT INTO analysis VALUES(%s)" % (",".join("?"*len(ANALYSIS_COLUMNS)),), [tuple(row) for row in rows.values()])
+    c.executemany(INSERT_LINK, links)
+    db.commit()
+    db.close()
+    print("%s: %i positions, %i links in %.3fs" % (db_name, len(rows), len(links), time.time() - t0))
+    return len(rows), len(links)
+
+if __name__=="__main__":
+    #synthetic_db.py positions [branching] [seed], writes chess.db in current directory
+    positions = int(sys.argv[1])
+    if len(sys.argv)>2: branching = int(sys.argv[2])
+    else: branching = 3
+    if len(sys.argv)>3: seed = int(sys.argv[3])
+    else: seed = 1
+    create_synthetic_db(positions, branching, seed)
@@ -0,0 +1,57 @@
+#python3 -m unittest discover tests, needs python-chess but no engines or chess.db
+import os, sys, random, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from undo_search import UndoSearch, LinkBoard, WORST_SCORE, find_cyclic
+from position_store import Entry
+
+class Positions:
+    def __init__(self):
+        self.entries = {}
+
+def random_search(seed, n=60):
+    #random link graph with cycles, cp scores only so mate distance does not matter
+    r = random.Random(seed)
+    s = UndoSearch.__new__(UndoSearch)
+    s.positions = Positions()
+    s.link_to = {}
+    for i in range(n):
+        s.positions.entries["p%i" % (i,)] = Entry("cp", r.randint(-300, 300), "", i, 0)
+    for i in range(n):
+        if r.random()<0.6:
+            pos2_dict = {"p%i" % (k,): "m%i_%i" % (i, k) for k in r.sample(range(n), r.randint(1, 4)) if k!=i}
+            if pos2_dict: s.link_to["p%i" % (i,)] = pos2_dict
+    s.link_to.setdefault("p0", {"p1": "m0_1"})
+    s.cyclic = find_cyclic(s.link_to)
+    s.tt = {}
+    s.tt_enabled = False
+    s.tt_generation = 0
+    s.tt_evicted = 0
+    s.tt_max_entries = 10**6
+    s.history_moves = {}
+    s.alpha_beta_nodes = 0
+    return s
+
+def search(s, tt):
+    s.tt_enabled = tt
+    s.tt_generation += 1
+    s.tt_hits = 0
+    result = s.alpha_beta_link_recursive(LinkBoard("p0", True), WORST_SCORE, -WORST_SCORE, False)
+    s.tt_enabled = False
+    return result
+
+class TTPVTest(unittest.TestCase):
+    def test_cyclic_graph_pv(self):
+        cyclic_graphs = 0
+        for seed in range(300):
+            s = random_search(seed)
+            if s.cyclic: cyclic_graphs += 1
+            #later searches start from entries of earlier ones, as in loop
+            tt_results = [search(s, True) for i in range(3)]
+            #same move ordering as last tt search
+            reference = search(s, False)
+            for result in tt_results:
+                self.assertEqual(result, reference, "seed %i" % (seed,))
+        self.assertGreater(cyclic_graphs, 100)
+
+if __name__=="__main__":
+    unittest.main()
@@ -3,7 +3,13 @@ import time, sys, os
 import chess.uci, chess.pgn
 import sqlite3
 from search_depth import *
+from link_graph import *
+from frontier import *
+from position_store import *
+from snapshot import *
 import collections
+import multiprocessing
+import tempfile, mmap, pickle
 
 ONE_SIDE_ONLY_FLAG = True
 UNDO_COLOR = chess.WHITE
@@ -15,6 +21,46 @@ WORST_SCORE = -1*10**7
 MATE_SCORE = 10**6
 TABLEBASE_SCORE = 10**4
 USE_LINKS_FLAG = True
+INCREMENTAL_FLAG = False #back up new scores along link_from instead of full alpha-beta each loop
+TT_FLAG = False #transposition table for alpha_beta_link_recursive kept between loop iterations
+TT_MEMORY_MB = 512
+TT_ENTRY_BYTES = 250 #rough size of dict slot + entry tuple
+TT_COMPARE_FLAG = False #also search without transposition table and log its node count
+FRONTIER = "pv" #"pv": expand alpha-beta PV leaf, "margin": score margin best-first leaves
+FRONTIER_EXPANSIONS = 4 #leaves per iteration for best-first frontiers
+FRONTIER_STABLE_CP = 10
+FRONTIER_STABLE_ITERATIONS = 5
+PARALLEL_WORKERS = 0 #processes forked at start for graph alpha-beta (GRAPH_FLAG), 0 searches in this process
+PARALLEL_COMPARE_FLAG = False #also search serially and log when score or pv differ
+#engines search predicted next expansions (best child of each expanded leaf, runner-up frontier leaves)
+#while commit, alpha-beta and frontier selection run, results are adopted when same variation is expanded,
+#otherwise kept by position until it is submitted again. Not with MULTIPV_FLAG
+SPECULATIVE_FLAG = False
+SPECULATIVE_RUNNER_UPS = 2
+MULTIPV_COMPARE_POSITIONS = 10 #alpha-beta PV positions for compare_multipv
+#refine: leaves of the critical tree (PV leaf, end of best line after moves of PV positions within
+#REFINE_MARGIN_CP of PV move) are searched again with twice their budget until root result stays same
+REFINE_MARGIN_CP = 30
+REFINE_STABLE_CP = 5
+REFINE_MAX_BUDGET_FACTOR = 16 #leaf budget grows up to this times nodes2search
+EXACT, LOWER, UPPER = range(3)
+GRAPH_FLAG = False #links kept only in array based LinkGraph, alpha-beta over it instead of link_to dicts
+ITERATIVE_FLAG = True #graph alpha-beta with explicit stack instead of recursion
+ZOBRIST_KEY_FLAG = False #key positions by the 64 bit hash column instead of fen strings
+SNAPSHOT_FLAG = False #start from snapshot of export_snapshot plus newer rows, export again on exit
+SNAPSHOT_NAME = "chess.snap"
+if ZOBRIST_KEY_FLAG: KEY = HASH
+else: KEY = POS
+if REPLAY_FLAG:
+    ENGINE_SCRIPTS = ((asmfish_id, "stockfish_replay"),
+                      (brainfish_id, "brainfish_replay"))
+else:
+    ENGINE_SCRIPTS = ((asmfish_id, "stockfish_log_time"),
+                      (brainfish_id, "brainfish_log"))
+
+def board2key(board):
+    if ZOBRIST_KEY_FLAG: return board2hash(board)
+    else: return fen2key(board.fen())
 
 def color2string(turn):
     if turn==chess.WHITE: return "white"
@@ -31,20 +77,21 @@ class LinkBoard:
     def push(self, pos2):
         self.pos_stack.append(self.pos)
         self.pos = pos2
-        self.transpositions.update((pos2,))
+        self.transpositions[pos2] += 1
         self.turn = not self.turn
         return pos2
 
     def pop(self):
         pos2 = self.pos
-        self.transpositions.subtract((pos2,))
+        self.transpositions[pos2] -= 1
         self.pos = self.pos_stack.pop()
         self.turn = not self.turn
         return pos2
                 
 
 class UndoSearch:
-    def __init__(self, nodes2search):
+    #links=False: positions only, for rebuild_links
+    def __init__(self, nodes2search, engine_count=ENGINE_COUNT, links=True):
         self.nodes2search = nodes2search
         self.log = Log("variation_%i" % (self.nodes2search,))
         if TABLEBASE31_FLAG:
@@ -53,28 +100,91 @@ class UndoSearch:
                 self.log_print_s("tablebase31 capture search enabled")
         if ONE_SIDE_ONLY_FLAG:
             self.log.print_s("one side only undo, color: " + color2string(UNDO_COLOR))
+        if ZOBRIST_KEY_FLAG:
+            self.log.print_s("zobrist hash keys")
+        self.start_parallel_pool()
         create_chess_db()
         self.db = sqlite3.connect(db_name, 60.0)
         self.c = self.db.cursor()
-        self.positions = {info[POS]: list(info) for info in self.c.execute("SELECT * FROM analysis")}
-        self.starting_pos = self.c.execute("SELECT fen FROM analysis WHERE ply=0").fetchall()[0][0]
+        #analysis_change is written only while a snapshot can use it. Done and committed
+        #before writer thread starts, so its connection never waits for this write lock
+        if SNAPSHOT_FLAG or os.path.exists(SNAPSHOT_NAME):
+            create_change_triggers(self.c)
+            prune_change_table(self.c)
+        else:
+            drop_change_triggers(self.c)
+            self.c.execute("DELETE FROM analysis_change")
+        self.db.commit()
+        self.writer = DBWriter(db_name)
+        self.writer.log = self.log
+        self.cache = EngineCache(db_name, self.writer)
+        self.tablebase = Tablebase()
+        self.starting_pos = self.c.execute("SELECT fen FROM analysis WHERE ply=0 LIMIT 1").fetchall()[0][0]
         self.nodes = 0
         self.link_to = {}
         self.link_from = {}
-        self.build_links()
-        self.info_handler = NodeHandler(self.nodes2search)
-        self.engine_dict = {}
-        for engine_id, engine_script in ((asmfish_id, "stockfish_log_time"),
-                                         (brainfish_id, "brainfish_log")):
-            self.program_id = engine_id
-            self.engine = chess.uci.popen_engine(engine_script)
-            self.engine.uci()
-            self.engine.info_handlers.append(self.info_handler)
-            self.engine.setoption({"Hash":1024, "SyzygyPath": "/usr/games/syzygy"})
-            self.engine_dict[engine_id] = (self.program_id, self.engine)
-        
+        self.links2store = []
+        self.node_values = {}
+        self.tt = {}
+        self.tt_enabled = False
+        self.tt_generation = 0
+        self.tt_evicted = 0
+        self.tt_max_entries = TT_MEMORY_MB*2**20//TT_ENTRY_BYTES
+        self.cyclic = set()
+        self.cycles_dirty = False
+        self.graph = None
+        self.graph_history = {}
+        #GRAPH_FLAG: links are only in self.graph, link_to and link_from stay empty
+        self.graph_links = USE_LINKS_FLAG and GRAPH_FLAG and not INCREMENTAL_FLAG
+        self.load_edges = None
+        t0 = time.time()
+        mem0 = resident_mb()
+        #rows and links written after these marks are applied on top of snapshot
+        #last seq of AUTOINCREMENT table, analysis_change itself is emptied by export_snapshot
+        self.change_seq = self.c.execute("SELECT IFNULL(MAX(seq), 0) FROM sqlite_sequence WHERE name='analysis_change'").fetchone()[0]
+        self.link_rowid = self.c.execute("SELECT IFNULL(MAX(rowid), 0) FROM link").fetchone()[0]
+        self.positions = PositionStore(self.c, KEY, load=False)
+        if links and self.load_snapshot():
+            self.log.print_s("%i positions, %i links from snapshot in %.3fs, resident memory +%.1fMB" % (len(self.positions), self.link_count, time.time() - t0, resident_mb() - mem0))
+        else:
+            self.positions.load()
+            self.log.print_s("%i positions loaded in %.3fs, resident memory +%.1fMB" % (len(self.positions), time.time() - t0, resident_mb() - mem0))
+            if links: self.build_links()
+        if self.graph:
+            self.log.print_s("graph: %i nodes, %i edges, %.1fMB arrays, resident memory +%.1fMB" % (
+                len(self.graph), len(self.graph.children), self.graph.memory()/2**20, resident_mb() - mem0))
+        self.pool_dict = {}
+        if engine_count:
+            for engine_id, engine_script in ENGINE_SCRIPTS:
+                self.pool_dict[engine_id] = EnginePool(engine_script, engine_count, self.nodes2search)
+            self.log.print_s("engines: %i" % (engine_count,))
+
         self.positions2store = []
         self.history_moves = {}
+        self.speculative = {} #(key, moves) -> future of speculative submit_position
+        self.speculative_kept = {} #key -> future of dropped speculative search that was already running
+        self.speculating = False
+        self.speculative_submitted = 0
+        self.speculative_adopted = 0
+        self.speculative_cancelled = 0
+        self.speculative_reused = 0
+
+    def start_parallel_pool(self):
+        #forked before db connection, writer and engine threads exist, workers are reused by every search
+        #and read graph of each search from file written by share_graph
+        global parallel_search
+        self.parallel_pool = None
+        self.parallel_search_id = 0
+        if PARALLEL_WORKERS>1 and GRAPH_FLAG:
+            parallel_search = self
+            self.parallel_pool = multiprocessing.get_context("fork").Pool(PARALLEL_WORKERS)
+            self.log.print_s("graph alpha-beta workers: %i" % (PARALLEL_WORKERS,))
+
+    def close_parallel_pool(self):
+        if self.parallel_pool:
+            self.parallel_pool.close()
+            self.parallel_pool.join()
+            self.parallel_pool = None
 
     def add_link_dict(self, link_dict, move, pos1, pos2):
         d = link_dict.get(pos1, {})
@@ -83,29 +193,154 @@ class UndoSearch:
         self.link_count += 1
 
     def add_link(self, move, pos1, pos2):
-        self.add_link_dict(self.link_to, move, pos1, pos2)
-        #self.add_link(self.link_from, pos2, pos1)
+        if self.graph_links:
+            self.graph.add_edge(pos1, pos2, move)
+            self.link_count += 1
+        else:
+            if INCREMENTAL_FLAG or TT_FLAG:
+                #link to position with children might close a cycle
+                if pos2 in self.link_to or pos2==pos1:
+                    self.cycles_dirty = True
+                self.link_from.setdefault(pos2, set()).add(pos1)
+                self.invalidate(pos1)
+            self.add_link_dict(self.link_to, move, pos1, pos2)
+            if self.graph:
+                self.graph.add_edge(pos1, pos2, move)
+        self.links2store.append((self.positions.entries[pos1].hash, self.positions.entries[pos2].hash, move))
+
+    def has_links(self, pos):
+        if self.graph_links:
+            node = self.graph.ids.get(pos)
+            return node is not None and self.graph.has_edges(node)
+        return pos in self.link_to
 
+    def get_pos2_dict(self, pos):
+        #children of pos by key with their moves, graph node ids are mapped back to keys here
+        if self.graph_links:
+            g = self.graph
+            node = g.ids.get(pos)
+            if node is None: return {}
+            return {g.keys[node2]: g.move_uci(code) for node2, code in g.edges(node)}
+        return self.link_to.get(pos, {})
+
+    def start_links(self):
+        self.link_count = 0
+        self.link_to = {}
+        if self.graph_links:
+            #links read at startup are collected in arrays, end_links builds CSR of graph from them
+            self.new_graph()
+            self.load_edges = (array("i"), array("i"), array("H"))
+
+    def new_graph(self):
+        #graph without edges, node ids in order of positions
+        self.graph = LinkGraph()
+        for key in self.positions:
+            self.graph.add_node(key, self.get_score(key))
+
+    def end_links(self):
+        if self.load_edges:
+            self.graph.load_edges(*self.load_edges)
+            self.load_edges = None
+        if (INCREMENTAL_FLAG or TT_FLAG) and not self.graph_links:
+            self.build_link_from()
+
+    def load_link(self, move, pos1, pos2):
+        if self.load_edges:
+            ids = self.graph.ids
+            src, dst, codes = self.load_edges
+            src.append(ids[pos1])
+            dst.append(ids[pos2])
+            codes.append(move2code(move))
+            self.link_count += 1
+        else:
+            self.add_link_dict(self.link_to, move, pos1, pos2)
+
+    def build_link_from(self):
+        self.link_from = {}
+        for pos, pos2_dict in self.link_to.items():
+            for pos2 in pos2_dict:
+                self.link_from.setdefault(pos2, set()).add(pos)
+        self.cycles_dirty = True
+
+    def invalidate(self, pos):
+        #cached value of pos and all its ancestors depend on pos
+        todo = [pos]
+        done = {pos}
+        while todo:
+            pos = todo.pop()
+            self.node_values.pop(pos, None)
+            self.tt.pop(pos, None)
+            for pos0 in self.link_from.get(pos, ()):
+                if pos0 not in done:
+                    done.add(pos0)
+                    todo.append(pos0)
+
+    @metrics.timed("build_links")
     def build_links(self):
         self.link_count = 0
         if not USE_LINKS_FLAG:
             return
         t0 = time.time()
-        for pos in self.positions:
-            board = chess.Board(pos + " 0 1")
+        missing = self.c.execute("SELECT COUNT(*) FROM link_missing").fetchone()[0]
+        if self.c.execute("SELECT 1 FROM link LIMIT 1").fetchone() and not missing:
+            self.start_links()
+            self.load_links()
+            how = "loaded"
+        else:
+            if missing:
+                self.log.print_s("link table misses links of %i search_depth.py runs, adding them" % (missing,))
+            elif len(self.positions)>1:
+                self.log.print_s("link table is empty, generating it (same as: undo_search.py rebuild_links)")
+            self.rebuild_links(add=missing>0)
+            how = "generated"
+        self.end_links()
+        time_elapsed = time.time() - t0
+        self.log.print_s("%i links build in %.3fs (%s)" % (self.link_count, time_elapsed, how))
+
+    def load_links(self):
+        self.links_skipped = 0
+        for pos1, pos2, m in self.link_positions(self.c.execute("SELECT hash1, hash2, move FROM link")):
+            self.load_link(m, pos1, pos2)
+        if self.links_skipped:
+            self.log.print_s("%i links to positions not in analysis skipped" % (self.links_skipped,))
+
+    def link_positions(self, links):
+        #(pos1, pos2, move) of link rows, rows with hash of no analysis row (deleted positions) are counted in links_skipped
+        if ZOBRIST_KEY_FLAG: hash2pos = None
+        else: hash2pos = {entry.hash: pos for pos, entry in self.positions.entries.items()}
+        for hash1, hash2, m in links:
+            if hash2pos is None:
+                pos1, pos2 = hash1, hash2
+            else:
+                pos1, pos2 = hash2pos.get(hash1), hash2pos.get(hash2)
+            if pos1 in self.positions and pos2 in self.positions:
+                yield pos1, pos2, m
+            else:
+                self.links_skipped += 1
+
+    def rebuild_links(self, add=False):
+        #add: link rows are kept (search_depth.py links all moves where ONE_SIDE_ONLY_FLAG links best move),
+        #missing ones are inserted and then all are loaded
+        self.start_links()
+        links = []
+        for fen_key, in self.c.execute("SELECT pos FROM analysis").fetchall():
+            board = chess.Board(fen_key + " 0 1")
+            pos = board2key(board)
+            entry = self.positions.entries[pos]
             pos2_lst = []
             if ONE_SIDE_ONLY_FLAG and board.turn!=UNDO_COLOR:
-                info = self.positions[pos]
-                m = info[PV].split()[0]
+                m = entry.move
+                #mated or stalemated position has no PV
+                if not m: continue
                 board.push_uci(m)
-                pos2 = fen2key(board.fen())
+                pos2 = board2key(board)
                 if pos2 in self.positions:
                     pos2_lst = [(m, pos2)]
                 #board.pop()
             else:
                 for m in board.generate_legal_moves():
                     board.push(m)
-                    pos2 = fen2key(board.fen())
+                    pos2 = board2key(board)
                     if pos2 not in self.positions:
                         pos2_lst = []
                         #board.pop()
@@ -113,12 +348,155 @@ class UndoSearch:
                     pos2_lst.append((str(m), pos2))
                     board.pop()
             for m, pos2 in pos2_lst:
-                self.add_link(m, pos, pos2)
-        time_elapsed = time.time() - t0
-        self.log.print_s("%i links build in %.3fs" % (self.link_count, time_elapsed))
+                self.load_link(m, pos, pos2)
+                links.append((entry.hash, self.positions.entries[pos2].hash, m))
+        if not add: self.c.execute("DELETE FROM link")
+        self.c.executemany(INSERT_LINK, links)
+        self.c.execute("DELETE FROM link_missing")
+        self.db.commit()
+        if add:
+            self.start_links()
+            self.load_links()
+            return
+        #rowids of link table start again, snapshot link_rowid mark can not tell which links are new
+        self.link_rowid = self.c.execute("SELECT IFNULL(MAX(rowid), 0) FROM link").fetchone()[0]
+        if os.path.exists(SNAPSHOT_NAME):
+            os.remove(SNAPSHOT_NAME)
+            self.log.print_s("%s removed, links were rebuilt" % (SNAPSHOT_NAME,))
+
+    def load_snapshot(self):
+        #False when there is no usable snapshot and everything is read from chess.db.
+        #Saves SQL and pv parsing of every row, Entry and link dicts are still built for all nodes
+        self.link_count = 0
+        if not SNAPSHOT_FLAG or not os.path.exists(SNAPSHOT_NAME):
+            return False
+        try:
+            snapshot = Snapshot(SNAPSHOT_NAME)
+        except ValueError as e:
+            self.log.print_s("snapshot ignored: %s" % (e,))
+            return False
+        if snapshot.zobrist_keys!=ZOBRIST_KEY_FLAG or snapshot.change_seq>self.change_seq or snapshot.link_rowid>self.link_rowid:
+            self.log.print_s("snapshot ignored: other key type or newer than %s" % (db_name,))
+            snapshot.close()
+            return False
+        if self.c.execute("SELECT 1 FROM link_missing LIMIT 1").fetchone():
+            self.log.print_s("snapshot ignored: links are rebuilt")
+            snapshot.close()
+            return False
+        keys = snapshot.keys()
+        uci = {0: ""}
+        entries = self.positions.entries
+        for key, (h, budget, value, code) in zip(keys, snapshot.nodes()):
+            m = uci.get(code)
+            if m is None: m = uci[code] = code2uci(code)
+            score_type, score = self.value_score(value)
+            entries[key] = Entry(score_type, score, m, h, budget)
+        offsets, children, moves = snapshot.offsets, snapshot.children, snapshot.moves
+        if self.graph_links:
+            #node ids of graph are snapshot node numbers, CSR arrays are copied as they are
+            self.new_graph()
+            self.graph.offsets = array("q", offsets.tobytes())
+            self.graph.children = array("i", children.tobytes())
+            self.graph.moves = array("H", moves.tobytes())
+            self.link_count = snapshot.edge_count
+        else:
+            for node, key in enumerate(keys):
+                i0 = offsets[node]
+                i1 = offsets[node+1]
+                if i0==i1: continue
+                pos2_dict = {}
+                for i in range(i0, i1):
+                    code = moves[i]
+                    m = uci.get(code)
+                    if m is None: m = uci[code] = code2uci(code)
+                    pos2_dict[keys[children[i]]] = m
+                self.link_to[key] = pos2_dict
+                self.link_count += i1 - i0
+        rows = self.c.execute("SELECT * FROM analysis WHERE pos IN (SELECT pos FROM analysis_change WHERE seq>?)", (snapshot.change_seq,)).fetchall()
+        for info in rows:
+            self.positions.add_row(info)
+            if self.graph: self.graph.add_node(info[KEY], self.get_score(info[KEY]))
+        links = self.c.execute("SELECT hash1, hash2, move FROM link WHERE rowid>?", (snapshot.link_rowid,)).fetchall()
+        self.links_skipped = 0
+        if links: links = list(self.link_positions(links))
+        if self.links_skipped:
+            self.log.print_s("%i links to positions not in analysis skipped" % (self.links_skipped,))
+        for pos1, pos2, m in links:
+            if self.graph_links:
+                self.graph.add_edge(pos1, pos2, m)
+                self.link_count += 1
+            else:
+                self.add_link_dict(self.link_to, m, pos1, pos2)
+        self.end_links()
+        self.log.print_s("snapshot %s: %i positions, %i links, newer in %s: %i rows, %i links" % (
+            SNAPSHOT_NAME, snapshot.node_count, snapshot.edge_count, db_name, len(rows), len(links)))
+        snapshot.close()
+        return True
+
+    def export_snapshot(self, filename=SNAPSHOT_NAME):
+        #rows written by other processes after startup marks are applied again on next start
+        t0 = time.time()
+        keys = list(self.positions)
+        ids = {key: node for node, key in enumerate(keys)}
+        nodes = []
+        offsets = [0]
+        children = []
+        moves = []
+        for key in keys:
+            entry = self.positions.entries[key]
+            if entry.move: code = move2code(entry.move)
+            else: code = 0
+            nodes.append((entry.hash, entry.budget, self.get_score(key), code))
+            for pos2, m in self.get_pos2_dict(key).items():
+                children.append(ids[pos2])
+                moves.append(move2code(m))
+            offsets.append(len(children))
+        if ZOBRIST_KEY_FLAG: fen_keys = None
+        else: fen_keys = keys
+        write_snapshot(filename, ZOBRIST_KEY_FLAG, self.change_seq, self.link_rowid, nodes, offsets, children, moves, fen_keys)
+        create_change_triggers(self.c)
+        self.c.execute("DELETE FROM analysis_change WHERE seq<=?", (self.change_seq,))
+        self.db.commit()
+        self.log.print_s("snapshot %s: %i positions, %i links exported in %.3fs, %i bytes" % (
+            filename, len(nodes), len(children), time.time() - t0, os.path.getsize(filename)))
+
+    def retrograde(self):
+        #minimax value of every position by vectorized passes over link graph (retrograde.py, needs numpy),
+        #stored in node_value table. Repetitions are valued once per position instead of per path,
+        #so inside cycles values can differ from alpha-beta
+        from retrograde import retrograde_values
+        t0 = time.time()
+        if self.graph_links:
+            g = self.graph
+            g.compact()
+        else:
+            g = build_link_graph(self.positions, self.link_to, self.get_score)
+        draw_white = self.draw_score(chess.WHITE)
+        draw_black = self.draw_score(chess.BLACK)
+        if draw_white==draw_black: draws = draw_white
+        else: draws = [draw_white if turn==chess.WHITE else draw_black for turn in self.node_turns(g.keys)]
+        values, passes, unstable = retrograde_values(g.offsets, g.children, g.scores, draws, MATE_SCORE)
+        time_values = time.time() - t0
+        self.c.execute("DELETE FROM node_value")
+        self.c.executemany("INSERT OR REPLACE INTO node_value VALUES(?,?)",
+                           zip((self.positions.entries[key].hash for key in g.keys), values.tolist()))
+        self.db.commit()
+        root = g.ids[self.best_position()]
+        self.log.print_s("retrograde: %i positions, %i links, %i passes, %i unstable set to draw, %.3fs (+%.3fs store), root %i" % (
+            len(g), len(g.children), passes, len(unstable), time_values, time.time() - t0 - time_values, values[root]))
+        return {key: value for key, value in zip(g.keys, values.tolist())}
+
+    def node_turns(self, keys):
+        if not ZOBRIST_KEY_FLAG:
+            return [key.split()[1]=="w" for key in keys]
+        #hash keys: side to move from ply
+        start_turn = chess.Board(self.starting_pos).turn
+        plies = dict(self.c.execute("SELECT hash, ply FROM analysis"))
+        plies.update((key, info[PLY]) for key, info in self.positions.rows.items())
+        return [start_turn if plies[key]%2==0 else not start_turn for key in keys]
 
     def best_position(self):
-        return fen2key(self.starting_pos)
+        return board2key(chess.Board(self.starting_pos))
 
     def draw_score(self, turn):
         if TABLEBASE31_FLAG:
@@ -150,38 +528,100 @@ class UndoSearch:
                         return score_now - TABLEBASE_SCORE
         return score_now
 
-    def analyse_position(self, board, info0, store_flag=True, only_pv=False):
-        if only_pv:
-            self.program_id, self.engine = self.engine_dict[brainfish_id]
+    @metrics.timed("analyse_position")
+    def analyse_position(self, board, info0, store_flag=True):
+        info = self.submit_position(board, info0).result()
+        if store_flag:
+            self.store_result(info)
         else:
-            self.program_id, self.engine = self.engine_dict[asmfish_id]
-        info = info0[:]
-        self.nodes += 1
-        count_info_prefix = str(self.nodes)
-        if only_pv: count_info_prefix = "PV " + count_info_prefix
-        self.info_handler.new_board(info[FEN], board, count_info_prefix)
-        self.engine.position(board)
+            return info
+
+    def submit_position(self, board, info0, budget=None):
+        if budget is None:
+            key = (board2key(board), info0[MOVES])
+            future = self.speculative.get(key)
+            if future and not future.cancelled():
+                #predicted twice
+                if self.speculating: return future
+                #speculative search counts as expanded node only when adopted
+                del self.speculative[key]
+                self.speculative_adopted += 1
+                self.nodes += 1
+                return future
+            future = self.speculative_kept.pop(key[0], None)
+            if future:
+                #dropped speculative search of same position, row gets moves of this variation
+                self.speculative_reused += 1
+                if not self.speculating: self.nodes += 1
+                return self.reuse_speculative(future, info0)
+        if self.speculating:
+            self.speculative_submitted += 1
+            count_info_prefix = "S%i" % (self.speculative_submitted,)
+        else:
+            self.nodes += 1
+            count_info_prefix = str(self.nodes)
+        result = self.tablebase.probe(board)
+        if result:
+            future = concurrent.futures.Future()
+            future.set_result(self.fill_tablebase(board, info0[:], result))
+            return future
+        return self.pool_dict[asmfish_id].submit(self.search_position, board.copy(), info0[:], count_info_prefix, False, budget)
+
+    def reuse_speculative(self, future, info0):
+        future2 = concurrent.futures.Future()
+        def done(future):
+            try:
+                info = future.result()
+            except Exception as e:
+                future2.set_exception(e)
+                return
+            if info[MOVES]!=info0[MOVES]:
+                info = info[:]
+                info[PLY] = info0[PLY] + 1
+                info[MOVES] = info0[MOVES]
+            future2.set_result(info)
+        future.add_done_callback(done)
+        return future2
+
+    def search_position(self, worker, board, info, count_info_prefix, only_pv=False, budget=None):
         #command = self.engine.go(infinite=True, async_callback=True)
         #command = self.engine.go(nodes=self.nodes2search, async_callback=True)
-        command = self.engine.go(movetime=self.nodes2search*1000/1000000, async_callback=True)
-        while not self.info_handler.stop_flag:
-            time.sleep(0.0001)
-        self.engine.stop()
-        res = command.result()
-        ires = self.info_handler.result
-        if not self.log.last_counter and only_pv:
-            self.log.last_counter = "only PV: " + ires.pv
+        if only_pv: program_id = brainfish_id
+        else: program_id = asmfish_id
+        if budget is None: budget = self.nodes2search
+        ires = self.cache.search(worker, program_id, budget, self.log, info[FEN], board, count_info_prefix, movetime=budget*1000/1000000)
+        if only_pv:
+            with self.log.lock:
+                if not self.log.last_counter: self.log.last_counter = "only PV: " + ires.pv
         self.log.print_s()
+        if only_pv:
+            return ires
+        return self.fill_position(board, info, ires, count_info_prefix, budget)
+
+    def fill_tablebase(self, board, info, result):
+        #exact result, no TABLEBASE31 adjustment or brainfish PV pass
+        self.fill_result(board, info, result)
+        self.log.print_s("tablebase: %s %s %s %s" % (info[POS], result.score_type, result.score, result.pv))
+        return info
+
+    def fill_result(self, board, info, result, budget=None):
+        #info is row of parent, becomes row of board
         info[POS] = fen2key(board.fen())
+        info[HASH] = board2hash(board)
         info[PLY] += 1
-        info[DEPTH] = ires.depth
-        info[SELDEPTH] = ires.seldepth
-        info[SCORE_TYPE] = ires.score_type
-        info[SCORE] = ires.score
-        info[NODES] = ires.nodes
-        info[TBHITS] = ires.tbhits
-        info[TIME] = ires.time
-        info[PV] = ires.pv
+        info[DEPTH] = result.depth
+        info[SELDEPTH] = result.seldepth
+        info[SCORE_TYPE] = result.score_type
+        info[SCORE] = result.score
+        info[NODES] = result.nodes
+        info[TBHITS] = result.tbhits
+        info[TIME] = result.time
+        info[PV] = result.pv
+        if hasattr(result, "program_id"): info[PROGRAM_ID] = result.program_id
+        info[BUDGET] = budget or self.nodes2search
+
+    def fill_position(self, board, info, ires, count_info_prefix, budget=None):
+        self.fill_result(board, info, ires, budget)
         if TABLEBASE31_FLAG and ires.score_type=="cp":
             if count_pieces(board)<32:
                 score = ires.score
@@ -197,38 +637,116 @@ class UndoSearch:
                 info[SCORE] = self.capture_search(board, info)
 
         #analyse again to get true pv, previous is scoring for alpha-beta undo side
-        if not only_pv and board.turn!=UNDO_COLOR:
-            info2 = self.analyse_position(board, info0, store_flag=False, only_pv=True)
-            info[PV] = info2[PV]
-        if store_flag:
-            self.store_result(info)
-        else:
-            return info
+        if board.turn!=UNDO_COLOR:
+            with self.pool_dict[brainfish_id].worker() as pv_worker:
+                ires2 = self.search_position(pv_worker, board, info, "PV " + count_info_prefix, only_pv=True)
+            info[PV] = ires2.pv
+        return info
 
     def analyse_1_move(self, board, info):
         self.log.print_s("-"*60)
-        pos = fen2key(board.fen())
+        self.store_futures(board2key(board), self.submit_1_move(board, info))
+
+    def analyse_all_moves(self, board, info):
+        self.log.print_s("-"*60)
+        self.store_futures(board2key(board), self.submit_all_moves(board, info))
+
+    def store_futures(self, pos, futures):
+        for m, pos2, future in futures:
+            self.store_result(future.result())
+            self.add_link(m, pos, pos2)
+
+    def submit_1_move(self, board, info):
         moves0 = info[MOVES]
         m = info[PV].split()[0]
         board.push_uci(m)
         info[MOVES] = " ".join((moves0, m))
-        self.analyse_position(board, info)
-        self.add_link(m, pos, fen2key(board.fen()))
+        futures = [(m, board2key(board), self.submit_position(board, info))]
         board.pop()
+        info[MOVES] = moves0
+        return futures
 
-    def analyse_all_moves(self, board, info):
-        self.log.print_s("-"*60)
-        pos = fen2key(board.fen())
+    def submit_all_moves(self, board, info):
+        if MULTIPV_FLAG:
+            return self.submit_multipv(board, info)
+        else:
+            return self.submit_per_move(board, info)
+
+    def submit_per_move(self, board, info):
+        #all children and their PV passes are searched at the same time by the engine pools
         moves0 = info[MOVES]
+        futures = []
         for m in board.generate_legal_moves():
             board.push(m)
             info[MOVES] = " ".join((moves0, str(m)))
-            self.analyse_position(board, info)
-            self.add_link(str(m), pos, fen2key(board.fen()))
+            futures.append((str(m), board2key(board), self.submit_position(board, info)))
+            board.pop()
+        info[MOVES] = moves0
+        return futures
+
+    def submit_multipv(self, board, info):
+        #one MultiPV search of parent scores all children, PV passes are still done per child
+        moves0 = info[MOVES]
+        legal_moves = list(board.generate_legal_moves())
+        movetime = self.nodes2search*1000/1000000*len(legal_moves)*MULTIPV_BUDGET_FACTOR
+        children = self.pool_dict[asmfish_id].submit(self.search_multipv, board.copy(), info[FEN], "MultiPV %i" % (self.nodes + 1,), len(legal_moves), movetime).result()
+        futures = []
+        for m in legal_moves:
+            board.push(m)
+            info[MOVES] = " ".join((moves0, str(m)))
+            if m in children and not self.tablebase.covers(board):
+                self.nodes += 1
+                future = self.pool_dict[brainfish_id].executor.submit(self.fill_position, board.copy(), info[:], children[m], str(self.nodes))
+            else:
+                future = self.submit_position(board, info)
+            futures.append((str(m), board2key(board), future))
             board.pop()
+        info[MOVES] = moves0
+        return futures
+
+    def search_multipv(self, worker, board, start_fen, count_info_prefix, multipv, movetime):
+        ires = worker.analyse(self.log, start_fen, board, count_info_prefix, multipv=multipv, movetime=movetime)
+        self.log.print_s()
+        return multipv_results(board, ires)
+
+    def compare_multipv(self, pv):
+        #children of alpha-beta PV positions searched per move and with MultiPV, nothing is stored
+        board = chess.Board(self.starting_pos)
+        times = [0.0, 0.0]
+        children = 0
+        diff_sum = 0
+        best_same = 0
+        positions = 0
+        for m in [None] + pv[:MULTIPV_COMPARE_POSITIONS-1]:
+            if m: board.push_uci(m)
+            pos = board2key(board)
+            if pos not in self.positions or board.is_game_over(): break
+            info = self.positions[pos][:]
+            scores = []
+            for i, submit in enumerate((self.submit_per_move, self.submit_multipv)):
+                t0 = time.time()
+                scores.append({m2: self.info_score(future.result()) for m2, pos2, future in submit(board, info)})
+                times[i] += time.time() - t0
+            per_move, multipv = scores
+            positions += 1
+            children += len(per_move)
+            diff_sum += sum(abs(per_move[m2] - multipv[m2]) for m2 in per_move)
+            #child scores are from child side, best move has lowest score
+            if min(per_move, key=per_move.get)==min(multipv, key=multipv.get):
+                best_same += 1
+            self.log.print_s("multipv compare %i %s: per move %.3fs, MultiPV %.3fs, avg diff %.1f, best move same %i/%i" % (
+                positions, pos, times[0], times[1], diff_sum/children, best_same, positions))
 
     def store_result(self, info):
-        self.positions[info[POS]] = info
+        entry = self.positions.entries.get(info[KEY])
+        if entry and entry.budget>(info[BUDGET] or 0):
+            #refined analysis with bigger budget wins, same rule as UPSERT_ANALYSIS
+            return
+        if (INCREMENTAL_FLAG or TT_FLAG) and info[KEY] in self.positions:
+            self.invalidate(info[KEY])
+        self.positions[info[KEY]] = info
+        if self.graph:
+            self.graph.add_node(info[KEY], self.get_score(info[KEY]))
         self.positions2store.append(info)
 
     def search(self):
@@ -253,16 +771,20 @@ class UndoSearch:
             self.commit()
             break
 
+    @metrics.timed("commit")
     def commit(self):
-        q_marks = ",".join(["?"]*len(self.positions2store[0]))
-        statement = "INSERT INTO analysis VALUES(%s)" % (q_marks,)
-        self.c.executemany(statement, self.positions2store)
-        self.db.commit()
+        #copies, writer thread must not see rows changed by later searches
+        self.writer.put(UPSERT_ANALYSIS, [tuple(info) for info in self.positions2store])
+        self.positions.written([info[KEY] for info in self.positions2store], self.writer.put_count)
+        self.writer.put(INSERT_LINK, self.links2store)
+        self.writer.commit()
+        self.positions.release(self.writer.done_count)
         self.positions2store = []
+        self.links2store = []
 
     def manual_search(self, moves):
         board = chess.Board(self.starting_pos)
-        info = self.positions[fen2key(self.starting_pos)]
+        info = self.positions[self.best_position()]
         for m in moves:
             if m=="all":
                 self.analyse_all_moves(board, info)
@@ -273,27 +795,111 @@ class UndoSearch:
             self.analyse_position(board, info)
 
     def search_variation(self, moves):
-        self.info_handler.log = self.log
-        board = chess.Board(self.starting_pos)
-        for m in moves:
-            board.push_uci(m)
-        info = self.positions[fen2key(board.fen())]
-        if ONE_SIDE_ONLY_FLAG and board.turn!=UNDO_COLOR:
-            self.analyse_1_move(board, info)
-        else:
-            self.analyse_all_moves(board, info)
+        self.search_variations([moves])
+
+    @metrics.timed("search_variations")
+    def search_variations(self, variations):
+        #all expansions are submitted before waiting, so engines get them in bulk
+        jobs = []
+        for moves in variations:
+            self.log.print_s("-"*60)
+            board = chess.Board(self.starting_pos)
+            for m in moves:
+                board.push_uci(m)
+            info = self.positions[board2key(board)]
+            if ONE_SIDE_ONLY_FLAG and board.turn!=UNDO_COLOR:
+                futures = self.submit_1_move(board, info)
+            else:
+                futures = self.submit_all_moves(board, info)
+            jobs.append((board2key(board), futures))
+        #speculative searches not adopted above must not delay these
+        self.drop_speculative()
+        for pos, futures in jobs:
+            self.store_futures(pos, futures)
+
+    def predict_variations(self, variations):
+        #alpha-beta PV usually goes on through best new child of expanded leaf,
+        #frontier leaves after the first FRONTIER_EXPANSIONS are next in line
+        predicted = []
+        for moves in variations[:FRONTIER_EXPANSIONS]:
+            pos2_dict = self.get_pos2_dict(board2key(moves2board(self.starting_pos, moves)))
+            if not pos2_dict: continue
+            #child scores are from child side
+            pos2 = min(pos2_dict, key=self.get_score)
+            predicted.append(moves + [pos2_dict[pos2]])
+        return predicted + variations[FRONTIER_EXPANSIONS:]
+
+    def speculate(self, variations):
+        self.speculating = True
+        for moves in variations:
+            board = moves2board(self.starting_pos, moves)
+            pos = board2key(board)
+            if self.has_links(pos) or pos not in self.positions or board.is_game_over(): continue
+            info = self.positions[pos]
+            if ONE_SIDE_ONLY_FLAG and board.turn!=UNDO_COLOR:
+                futures = self.submit_1_move(board, info)
+            else:
+                futures = self.submit_per_move(board, info)
+            for m, pos2, future in futures:
+                self.speculative[(pos2, " ".join((info[MOVES], m)))] = future
+        self.speculating = False
+
+    def drop_speculative(self):
+        #searches not started yet are cancelled, running and finished ones are kept by position
+        for (pos2, moves), future in self.speculative.items():
+            if future.cancel():
+                self.speculative_cancelled += 1
+            else:
+                self.speculative_kept[pos2] = future
+        self.speculative = {}
+
+    def engine_busy(self):
+        return [pool.busy_seconds() for engine_id, pool in sorted(self.pool_dict.items())]
+
+    def utilisation_str(self, busy0, busy1, seconds):
+        engine_count = self.pool_dict[asmfish_id].engine_count
+        return "engine utilisation: %s" % (", ".join("%i %.1f%%" % (engine_id, 100*(b1 - b0)/max(seconds*engine_count, 0.001))
+                                                    for engine_id, b0, b1 in zip(sorted(self.pool_dict), busy0, busy1)),)
+
+    def log_stability(self, frontier, score):
+        #engine searches until root score stays within FRONTIER_STABLE_CP for FRONTIER_STABLE_ITERATIONS
+        self.root_scores.append(score)
+        last = self.root_scores[-FRONTIER_STABLE_ITERATIONS:]
+        stable = len(last)==FRONTIER_STABLE_ITERATIONS and max(last) - min(last)<=FRONTIER_STABLE_CP
+        if stable and not self.root_stable:
+            s = "root score %i stable (%icp/%i iterations) after %i engine searches, %s frontier" % (
+                score, FRONTIER_STABLE_CP, FRONTIER_STABLE_ITERATIONS, self.nodes, frontier.name)
+            self.log.print_s(s)
+            self.alpha_beta_log.print_s(s)
+        self.root_stable = stable
 
     def get_score(self, pos):
-        info = self.positions[pos]
-        score = info[SCORE]
-        if info[SCORE_TYPE]=="mate":
+        #hot in alpha-beta, score_value inlined
+        entry = self.positions.entries[pos]
+        if entry.score_type=="mate":
+            if entry.score<0: return -MATE_SCORE-entry.score
+            else: return MATE_SCORE-entry.score
+        return entry.score
+
+    def info_score(self, info):
+        return self.score_value(info[SCORE_TYPE], info[SCORE])
+
+    def value_score(self, value):
+        #inverse of score_value, for snapshot scores
+        if abs(value)+1000 > MATE_SCORE:
+            if value>0: return "mate", MATE_SCORE-value
+            else: return "mate", -MATE_SCORE-value
+        return "cp", value
+
+    def score_value(self, score_type, score):
+        if score_type=="mate":
             if score<0: return -MATE_SCORE-score
             else: return MATE_SCORE-score
         return score
 
     def alpha_beta_recursive(self, board, alpha, beta, print_flag):
         self.alpha_beta_nodes += 1
-        pos = fen2key(board.fen())
+        pos = board2key(board)
         #print("%i POS: %s" % (self.alpha_beta_nodes, pos))
         if pos not in self.positions: return
         if board.transpositions[board.zobrist_hash()] >= 2:
@@ -307,10 +913,9 @@ class UndoSearch:
         best_pv = []
         score_moves = []
         if ONE_SIDE_ONLY_FLAG and board.turn!=UNDO_COLOR:
-            info = self.positions[pos]
-            m = info[PV].split()[0]
+            m = self.positions.entries[pos].move
             board.push_uci(m)
-            pos2 = fen2key(board.fen())
+            pos2 = board2key(board)
             board.pop()
             if pos2 not in self.positions:
                 return self.get_score(pos), []
@@ -319,7 +924,7 @@ class UndoSearch:
             history_move = self.history_moves.get(pos, "")
             for m in board.generate_legal_moves():
                 board.push(m)
-                pos2 = fen2key(board.fen())
+                pos2 = board2key(board)
                 board.pop()
                 if pos2 not in self.positions:
                     return self.get_score(pos), []
@@ -361,7 +966,21 @@ class UndoSearch:
         score_moves = []
         if pos not in self.link_to:
             return self.get_score(pos), []
-        history_move = self.history_moves.get(pos, "")
+        entry = None
+        if self.tt_enabled:
+            entry = self.tt.get(pos)
+            if entry and entry[4]!=self.tt_generation:
+                #entry used by this search is not evicted as old
+                entry = self.tt[pos] = entry[:4] + (self.tt_generation,)
+            #values of positions on cycles depend on the path, their entries are only for move ordering
+            if entry and pos not in self.cyclic:
+                score, bound = entry[0], entry[1]
+                if bound==EXACT or (bound==LOWER and score>=beta) or (bound==UPPER and score<=alpha):
+                    self.tt_hits += 1
+                    return score, self.tt_pv(lboard, pos)
+        alpha0 = alpha
+        if entry: history_move = entry[2]
+        else: history_move = self.history_moves.get(pos, "")
         pos2_dict = self.link_to[pos]
         for pos2 in pos2_dict:
             m = pos2_dict[pos2]
@@ -380,6 +999,7 @@ class UndoSearch:
                 if print_flag: print("new best_score")
                 best_score = score
                 best_pv = [m] + pv
+                best_pos2 = pos2
                 if score >= alpha:
                     if print_flag: print("new alpha")
                     alpha = score
@@ -388,42 +1008,585 @@ class UndoSearch:
                         break
         if print_flag: print("-"*60)
         self.history_moves[pos] = best_pv[0]
+        if self.tt_enabled:
+            if best_score<=alpha0: bound = UPPER
+            elif best_score>=beta: bound = LOWER
+            else: bound = EXACT
+            self.tt_store(pos, best_score, bound, best_pv[0], best_pos2)
+        return best_score, best_pv
+
+    def tt_store(self, pos, score, bound, m, pos2):
+        if len(self.tt)>=self.tt_max_entries and pos not in self.tt:
+            self.tt_evict()
+            if len(self.tt)>=self.tt_max_entries: return
+        self.tt[pos] = (score, bound, m, pos2, self.tt_generation)
+
+    def tt_evict(self):
+        #drop entries of older searches, at most once per search
+        if self.tt_evicted==self.tt_generation: return
+        self.tt_evicted = self.tt_generation
+        for generation in (self.tt_generation - 2, self.tt_generation - 1):
+            for pos in [pos for pos, entry in self.tt.items() if entry[4]<=generation]:
+                del self.tt[pos]
+            if len(self.tt)<self.tt_max_entries*9//10: break
+        self.log.print_s("tt evicted, %i entries left" % (len(self.tt),))
+
+    def tt_pv(self, lboard, pos):
+        #best moves of EXACT entries of positions not on cycles. Rest of pv from a position with links
+        #whose entry is missing (evicted or not stored), a bound or path dependent (cyclic) is searched.
+        #Hit itself is EXACT on pv, bound hit is a cut position and its pv is not used
+        pv = []
+        pushed = 0
+        while True:
+            entry = self.tt.get(pos)
+            if pushed and (entry is None or entry[1]!=EXACT or pos in self.cyclic):
+                if pos in self.link_to:
+                    score, pv2 = self.alpha_beta_link_recursive(lboard, WORST_SCORE, -WORST_SCORE, False)
+                    pv += pv2
+                break
+            if entry is None or entry[1]!=EXACT: break
+            m, pos = entry[2:4]
+            pv.append(m)
+            #repetition is a draw leaf as in search
+            if lboard.transpositions[pos] >= 1: break
+            lboard.push(pos)
+            pushed += 1
+        for i in range(pushed):
+            lboard.pop()
+        return pv
+
+    def alpha_beta_graph_recursive(self, node, turn, alpha, beta):
+        self.alpha_beta_nodes += 1
+        g = self.graph
+        if self.on_path[node]:
+            return self.draw_score(turn), []
+        i0 = g.offsets[node]
+        i1 = g.offsets[node+1]
+        if i0==i1 and node not in g.extra:
+            return g.scores[node], []
+        best_score = WORST_SCORE
+        best_pv = []
+        scores = g.scores
+        history_move = self.graph_history.get(node, -1)
+        if g.extra:
+            edges = g.edges(node)
+        else:
+            edges = zip(g.children[i0:i1], g.moves[i0:i1])
+        score_moves = sorted([(scores[node2] - 100*(code==history_move), code, node2) for node2, code in edges])
+        self.on_path[node] = 1
+        for mscore, code, node2 in score_moves:
+            score, pv = self.alpha_beta_graph_recursive(node2, not turn, -beta, -alpha)
+            score = -score
+            if score + 1000 > MATE_SCORE: score -= 1
+            if score > best_score:
+                best_score = score
+                best_pv = [g.move_uci(code)] + pv
+                best_code = code
+                if score >= alpha:
+                    alpha = score
+                    if score >= beta:
+                        break
+        self.on_path[node] = 0
+        self.graph_history[node] = best_code
+        return best_score, best_pv
+
+    def alpha_beta_graph_iterative(self, root, root_turn, root_alpha=WORST_SCORE, root_beta=-WORST_SCORE):
+        #same search as alpha_beta_graph_recursive with an explicit stack,
+        #per ply buffers are reused and pv is kept as triangular table of move codes
+        g = self.graph
+        scores = g.scores
+        offsets = g.offsets
+        extra = g.extra
+        on_path = self.on_path
+        history = self.graph_history
+        no_pv = []
+        node_s, alpha_s, beta_s, best_s, code_s, moves_s, index_s, pv_s = [], [], [], [], [], [], [], [no_pv]
+        self.alpha_beta_nodes += 1
+        if offsets[root]==offsets[root+1] and root not in extra:
+            return scores[root], []
+        nodes = 0
+        top = -1
+        node, alpha, beta = root, root_alpha, root_beta
+        while True:
+            #enter node with children as new frame
+            top += 1
+            if top==len(node_s):
+                for stack in (node_s, alpha_s, beta_s, best_s, code_s, moves_s, index_s, pv_s):
+                    stack.append(None)
+            history_move = history.get(node, -1)
+            moves = sorted([(scores[node2] - 100*(code==history_move), code, node2) for node2, code in g.edges(node)])
+            node_s[top] = node
+            alpha_s[top] = alpha
+            beta_s[top] = beta
+            best_s[top] = WORST_SCORE
+            moves_s[top] = moves
+            pv_s[top] = no_pv
+            on_path[node] = 1
+            i = 0
+            #search children of frame top, leaves and repetitions are scored without new frame
+            while True:
+                if i:
+                    score = -score
+                    if score + 1000 > MATE_SCORE: score -= 1
+                    if score > best_s[top]:
+                        code = moves[i-1][1]
+                        best_s[top] = score
+                        code_s[top] = code
+                        pv_s[top] = [code] + pv_s[top+1]
+                        if score >= alpha_s[top]:
+                            alpha_s[top] = score
+                            if score >= beta_s[top]:
+                                i = len(moves)
+                if i<len(moves):
+                    node = moves[i][2]
+                    i += 1
+                    nodes += 1
+                    if on_path[node]:
+                        score = self.draw_score(root_turn if top%2 else not root_turn)
+                        pv_s[top+1] = no_pv
+                    elif offsets[node]==offsets[node+1] and node not in extra:
+                        score = scores[node]
+                        pv_s[top+1] = no_pv
+                    else:
+                        index_s[top] = i
+                        alpha, beta = -beta_s[top], -alpha_s[top]
+                        break
+                else:
+                    on_path[node_s[top]] = 0
+                    history[node_s[top]] = code_s[top]
+                    score = best_s[top]
+                    if top==0:
+                        self.alpha_beta_nodes += nodes
+                        return score, [g.move_uci(code) for code in pv_s[0]]
+                    top -= 1
+                    moves = moves_s[top]
+                    i = index_s[top]
+
+    def search_graph(self):
+        if not self.graph:
+            #link_to built without GRAPH_FLAG, graph is an extra copy (bench.py compares modes)
+            t0 = time.time()
+            self.graph = build_link_graph(self.positions, self.link_to, self.get_score)
+            self.graph_history = {}
+            self.log.print_s("graph: %i nodes, %i edges, %.1fMB arrays, build in %.3fs" % (
+                len(self.graph), len(self.graph.children), self.graph.memory()/2**20, time.time() - t0))
+        self.on_path = bytearray(len(self.graph))
+        board = chess.Board(self.starting_pos)
+        root = self.graph.ids[self.best_position()]
+        if self.parallel_pool:
+            history = dict(self.graph_history)
+            t0 = time.time()
+            score, pv = self.search_graph_parallel(root, board.turn)
+            if PARALLEL_COMPARE_FLAG:
+                self.compare_serial(root, board.turn, history, score, pv, time.time() - t0)
+            return score, pv
+        if ITERATIVE_FLAG:
+            return self.alpha_beta_graph_iterative(root, board.turn)
+        else:
+            return self.alpha_beta_graph_recursive(root, board.turn, WORST_SCORE, -WORST_SCORE)
+
+    def compare_serial(self, root, turn, history, score, pv, time_parallel):
+        #serial search from same history, then history and node count of parallel search are restored
+        history_parallel = self.graph_history
+        nodes = self.alpha_beta_nodes
+        self.graph_history = history
+        t0 = time.time()
+        if ITERATIVE_FLAG:
+            score2, pv2 = self.alpha_beta_graph_iterative(root, turn)
+        else:
+            score2, pv2 = self.alpha_beta_graph_recursive(root, turn, WORST_SCORE, -WORST_SCORE)
+        time_serial = time.time() - t0
+        if score==score2 and pv==pv2: same = "same"
+        elif score==score2: same = "same score, other pv " + " ".join(pv2)
+        else: same = "DIFFERENT, serial %i %s" % (score2, " ".join(pv2))
+        self.log.print_s("parallel %i workers: %.3fs, serial %.3fs, speedup %.2f, result %s" % (
+            PARALLEL_WORKERS, time_parallel, time_serial, time_serial/max(time_parallel, 0.001), same))
+        self.graph_history = history_parallel
+        self.alpha_beta_nodes = nodes
+
+    def search_graph_child(self, node, turn, alpha, beta):
+        #on_path is set for nodes above node
+        if self.on_path[node]:
+            self.alpha_beta_nodes += 1
+            return self.draw_score(turn), []
+        if ITERATIVE_FLAG:
+            return self.alpha_beta_graph_iterative(node, turn, alpha, beta)
+        else:
+            return self.alpha_beta_graph_recursive(node, turn, alpha, beta)
+
+    def search_graph_parallel(self, root, turn):
+        #young brothers wait at first node with several children (split node) only: its first child is
+        #searched here, others by pool workers with alpha of first child, each of them serially,
+        #same window tightening as serial search gives same score and pv.
+        #Every child starts from history at split, so result does not depend on scheduling,
+        #pv can differ from serial search only between moves of equal score
+        g = self.graph
+        on_path = self.on_path
+        chain = []
+        node = root
+        root_turn = turn
+        while True:
+            edges = g.edges(node)
+            if len(edges)!=1 or on_path[edges[0][0]] or not g.has_edges(edges[0][0]): break
+            on_path[node] = 1
+            chain.append((node, edges[0][1]))
+            node = edges[0][0]
+            turn = not turn
+        if len(edges)<2:
+            for node0, code in chain:
+                on_path[node0] = 0
+            if ITERATIVE_FLAG: return self.alpha_beta_graph_iterative(root, root_turn)
+            else: return self.alpha_beta_graph_recursive(root, root_turn, WORST_SCORE, -WORST_SCORE)
+        self.alpha_beta_nodes += len(chain) + 1
+        history_move = self.graph_history.get(node, -1)
+        moves = sorted([(g.scores[node2] - 100*(code==history_move), code, node2) for node2, code in edges])
+        on_path[node] = 1
+        results = [self.search_graph_child(moves[0][2], not turn, WORST_SCORE, -WORST_SCORE)]
+        alpha = -results[0][0]
+        if alpha + 1000 > MATE_SCORE: alpha -= 1
+        filename, sizes = self.share_graph()
+        tasks = [(filename, self.parallel_search_id, sizes, node2, not turn, WORST_SCORE, -alpha) for mscore, code, node2 in moves[1:]]
+        try:
+            for score, pv, nodes, history in self.parallel_pool.map(search_graph_task, tasks, 1):
+                results.append((score, pv))
+                self.alpha_beta_nodes += nodes
+                self.graph_history.update(history)
+        finally:
+            #workers keep their mapping until next search
+            os.remove(filename)
+        best_score = WORST_SCORE
+        for (mscore, code, node2), (score, pv) in zip(moves, results):
+            score = -score
+            if score + 1000 > MATE_SCORE: score -= 1
+            if score > best_score:
+                best_score = score
+                best_pv = [g.move_uci(code)] + pv
+                best_code = code
+        on_path[node] = 0
+        self.graph_history[node] = best_code
+        for node0, code in reversed(chain):
+            on_path[node0] = 0
+            self.graph_history[node0] = code
+            best_score = -best_score
+            if best_score + 1000 > MATE_SCORE: best_score -= 1
+            best_pv = [g.move_uci(code)] + best_pv
+        return best_score, best_pv
+
+    def share_graph(self):
+        #graph arrays, on_path of split node and pickled history for pool workers,
+        #offsets first so every array is aligned in the mapping
+        g = self.graph
+        if g.extra: g.compact()
+        parts = [g.offsets.tobytes(), g.scores.tobytes(), g.children.tobytes(), g.moves.tobytes(),
+                 bytes(self.on_path), pickle.dumps(self.graph_history, pickle.HIGHEST_PROTOCOL)]
+        with tempfile.NamedTemporaryFile(prefix="graph_", delete=False) as fp:
+            for part in parts:
+                fp.write(part)
+        self.parallel_search_id += 1
+        return fp.name, [len(part) for part in parts]
+
+    def attach_graph(self, filename, search_id, sizes):
+        #in pool worker, graph arrays are views of mapped file, mapping of previous search is freed with them
+        with open(filename, "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        views = []
+        i = 0
+        for size in sizes:
+            views.append(memoryview(mm)[i:i + size])
+            i += size
+        offsets, scores, children, moves, on_path, history = views
+        g = LinkGraph()
+        g.offsets = offsets.cast("q")
+        g.scores = scores.cast("i")
+        g.children = children.cast("i")
+        g.moves = moves.cast("H")
+        self.graph = g
+        self.on_path = bytearray(on_path)
+        self.fork_history = pickle.loads(history)
+        self.parallel_search_id = search_id
+
+    def incremental_recursive(self, lboard, alpha, beta):
+        #same as alpha_beta_link_recursive, but positions that are not part of any cycle
+        #can't reach a repetition of the path above them, so their exact value is cached
+        self.alpha_beta_nodes += 1
+        pos = lboard.pos
+        if lboard.transpositions[pos] >= 2:
+            return self.draw_score(lboard.turn), ()
+        if pos not in self.link_to:
+            return self.get_score(pos), ()
+        if pos in self.node_values:
+            return self.node_values[pos]
+        exact_flag = pos not in self.cyclic
+        if exact_flag:
+            alpha, beta = WORST_SCORE, -WORST_SCORE
+        best_score = WORST_SCORE
+        best_pv = ()
+        pos2_dict = self.link_to[pos]
+        for mscore, m, pos2 in sorted([(self.get_score(pos2), pos2_dict[pos2], pos2) for pos2 in pos2_dict]):
+            lboard.push(pos2)
+            score, pv = self.incremental_recursive(lboard, -beta, -alpha)
+            lboard.pop()
+            score = -score
+            if score + 1000 > MATE_SCORE: score -= 1
+            if score > best_score:
+                best_score = score
+                best_pv = (m, pv)
+                if score >= alpha:
+                    alpha = score
+                    if score >= beta:
+                        break
+        if exact_flag:
+            self.node_values[pos] = best_score, best_pv
         return best_score, best_pv
 
+    def search_incremental(self):
+        if self.cycles_dirty:
+            self.cyclic = find_cyclic(self.link_to)
+            self.cycles_dirty = False
+        lboard = LinkBoard(self.best_position(), chess.Board(self.starting_pos).turn)
+        score, pv = self.incremental_recursive(lboard, WORST_SCORE, -WORST_SCORE)
+        pv_lst = []
+        while pv:
+            m, pv = pv
+            pv_lst.append(m)
+        return score, pv_lst
+
+    @metrics.timed("search_alpha_beta")
     def search_alpha_beta(self, print_flag=False, alpha_beta_log=None):
         self.alpha_beta_nodes = 0
         board = chess.Board(self.starting_pos)
         t0 = time.time()
-        if USE_LINKS_FLAG:
-            lboard = LinkBoard(fen2key(board.fen()), board.turn)
+        info_s = ""
+        if USE_LINKS_FLAG and INCREMENTAL_FLAG:
+            score, pv = self.search_incremental()
+            info_s = "/%ic/%icy" % (len(self.node_values), len(self.cyclic))
+        elif USE_LINKS_FLAG and GRAPH_FLAG:
+            score, pv = self.search_graph()
+        elif USE_LINKS_FLAG and TT_FLAG:
+            if self.cycles_dirty:
+                self.cyclic = find_cyclic(self.link_to)
+                self.cycles_dirty = False
+            self.tt_generation += 1
+            self.tt_hits = 0
+            self.tt_enabled = True
+            lboard = LinkBoard(board2key(board), board.turn)
+            score, pv = self.alpha_beta_link_recursive(lboard, WORST_SCORE, -WORST_SCORE, print_flag)
+            self.tt_enabled = False
+            info_s = "/%itt/%ih" % (len(self.tt), self.tt_hits)
+            if TT_COMPARE_FLAG:
+                tt_nodes = self.alpha_beta_nodes
+                self.alpha_beta_nodes = 0
+                lboard = LinkBoard(board2key(board), board.turn)
+                self.alpha_beta_link_recursive(lboard, WORST_SCORE, -WORST_SCORE, False)
+                info_s += "/%in-no-tt" % (self.alpha_beta_nodes,)
+                self.alpha_beta_nodes = tt_nodes
+        elif USE_LINKS_FLAG:
+            lboard = LinkBoard(board2key(board), board.turn)
             score, pv = self.alpha_beta_link_recursive(lboard, WORST_SCORE, -WORST_SCORE, print_flag)
         else:
             score, pv = self.alpha_beta_recursive(board, WORST_SCORE, -WORST_SCORE, print_flag)
         time_elapsed = time.time() - t0
         with open("t.pgn", "w") as fp: fp.write(moves2pgn(self.starting_pos, pv))
-        alpha_beta_s = "%i(%in/%ip) %.3fs %s" % (score, self.alpha_beta_nodes, len(self.positions), time_elapsed, moves2san(self.starting_pos, pv))
+        info_s += "/%inps" % (self.alpha_beta_nodes/max(time_elapsed, 0.001),)
+        metrics.count("alpha_beta_nodes", self.alpha_beta_nodes)
+        alpha_beta_s = "%i(%in/%ip%s) %.3fs %s" % (score, self.alpha_beta_nodes, len(self.positions), info_s, time_elapsed, moves2san(self.starting_pos, pv))
         self.log.print_s(alpha_beta_s)
         if alpha_beta_log: alpha_beta_log.print_s(alpha_beta_s)
         return score, pv
 
     def loop(self):
         self.alpha_beta_log = Log("alpha_beta_%i" % (self.nodes2search,))
+        metrics.start("undo_search")
+        frontier = FRONTIERS[FRONTIER](self)
+        self.log.print_s("frontier: %s, expansions: %i" % (frontier.name, FRONTIER_EXPANSIONS))
+        speculative = SPECULATIVE_FLAG and not MULTIPV_FLAG
+        if speculative:
+            self.log.print_s("speculative analysis, runner-ups: %i" % (SPECULATIVE_RUNNER_UPS,))
+            expansions = FRONTIER_EXPANSIONS + SPECULATIVE_RUNNER_UPS
+        else:
+            expansions = FRONTIER_EXPANSIONS
+        self.root_scores = []
+        self.root_stable = False
+        t_loop = time.time()
+        busy_loop = self.engine_busy()
         while not os.path.exists(BREAK_SEARCH):
+            t0 = time.time()
+            busy0 = self.engine_busy()
             score, pv = self.search_alpha_beta(False, self.alpha_beta_log)
+            self.log_stability(frontier, score)
             if abs(score)+1000 > MATE_SCORE:
                 board = moves2board(self.starting_pos, pv)
-                pv2 = self.positions[fen2key(board.fen())][PV]
+                pv2 = self.positions[board2key(board)][PV]
                 s = "mating score with pv: %s" % (pv2,)
                 self.log.print_s(s)
                 self.alpha_beta_log.print_s(s)
                 with open("game.pgn", "w") as fp:
                     fp.write(moves2pgn(self.starting_pos, pv + pv2.split()))
+                self.log_loop_end(t_loop, busy_loop)
                 return
-            self.search_variation(pv)
+            cpu0 = time.process_time()
+            nodes0 = self.nodes
+            variations = frontier.select(pv, expansions)
+            if not variations:
+                #every reachable leaf is game over or reached only by repetition
+                s = "%s frontier: nothing to expand" % (frontier.name,)
+                self.log.print_s(s)
+                self.alpha_beta_log.print_s(s)
+                break
+            self.search_variations(variations[:FRONTIER_EXPANSIONS])
+            if speculative:
+                self.speculate(self.predict_variations(variations))
             self.commit()
+            self.log.print_s(driver_cpu_str(time.process_time() - cpu0, self.nodes - nodes0))
+            self.log.print_s(self.utilisation_str(busy0, self.engine_busy(), time.time() - t0))
+            self.log.print_s("%s, tablebase probes: %i" % (self.cache.stats_str(), self.tablebase.probes))
+            self.log.print_s(self.positions.stats_str())
         score, pv = self.search_alpha_beta(False, self.alpha_beta_log)
+        self.log_loop_end(t_loop, busy_loop)
         if os.path.exists(BREAK_SEARCH): os.remove(BREAK_SEARCH)
 
+    def critical_leaves(self, pv):
+        #leaves whose scores decide root result: PV leaf and, for every PV position, the leaf
+        #at the end of the best line after each other move that is within REFINE_MARGIN_CP of the PV move
+        board = chess.Board(self.starting_pos)
+        pos = self.best_position()
+        values = MarginFrontier(self).node_values(pos, board.turn)
+        leaves = {}
+        moves = []
+        for m in pv + [None]:
+            pos2_dict = self.get_pos2_dict(pos)
+            for pos2, m2 in pos2_dict.items():
+                if m2==m or pos2 not in values: continue
+                if -values[pos2]<values[pos] - REFINE_MARGIN_CP: continue
+                leaf = self.best_line_leaf(pos2, moves + [m2], values)
+                if leaf: leaves.setdefault(leaf[0], leaf[1])
+            if m is None: break
+            pos = [pos2 for pos2, m2 in pos2_dict.items() if m2==m][0]
+            moves = moves + [m]
+        if not self.has_links(pos):
+            leaves.setdefault(pos, moves)
+        return leaves
+
+    def best_line_leaf(self, pos, moves, values):
+        #side to move picks child with lowest value from child side, None for line ending in repetition
+        seen = set()
+        while self.has_links(pos):
+            if pos in seen: return None
+            seen.add(pos)
+            pos2_dict = self.get_pos2_dict(pos)
+            pos2 = min(pos2_dict, key=lambda pos2: values.get(pos2, -WORST_SCORE))
+            moves = moves + [pos2_dict[pos2]]
+            pos = pos2
+        return pos, moves
+
+    def refine(self):
+        self.alpha_beta_log = Log("alpha_beta_%i" % (self.nodes2search,))
+        self.log.print_s("refine: margin %icp, budget up to %i" % (REFINE_MARGIN_CP, REFINE_MAX_BUDGET_FACTOR*self.nodes2search))
+        t_loop = time.time()
+        busy_loop = self.engine_busy()
+        last = None
+        while not os.path.exists(BREAK_SEARCH):
+            score, pv = self.search_alpha_beta(False, self.alpha_beta_log)
+            if last and abs(score - last[0])<=REFINE_STABLE_CP and pv==last[1]:
+                self.log.print_s("refine: root result stable")
+                break
+            last = score, pv
+            t0 = time.time()
+            busy0 = self.engine_busy()
+            leaves = self.critical_leaves(pv)
+            jobs = []
+            for pos, moves in leaves.items():
+                info = self.positions[pos]
+                budget = 2*(info[BUDGET] or self.nodes2search)
+                if not moves or budget>REFINE_MAX_BUDGET_FACTOR*self.nodes2search or info[PROGRAM_ID]==syzygy_id: continue
+                board = moves2board(self.starting_pos, moves)
+                if board.is_game_over(): continue
+                #leaf row stands for parent row, fill_position adds one ply
+                info0 = info[:]
+                info0[PLY] -= 1
+                jobs.append((self.info_score(info), budget, self.submit_position(board, info0, budget)))
+            if not jobs:
+                self.log.print_s("refine: all %i critical leaves at maximum budget" % (len(leaves),))
+                break
+            changed = 0
+            for old_score, budget, future in jobs:
+                info = future.result()
+                if self.info_score(info)!=old_score: changed += 1
+                self.store_result(info)
+            self.commit()
+            self.log.print_s("refine: %i of %i critical leaves searched again, budget up to %i, %i scores changed, %.3fs, %s" % (
+                len(jobs), len(leaves), max(budget for old_score, budget, future in jobs), changed, time.time() - t0,
+                self.utilisation_str(busy0, self.engine_busy(), time.time() - t0)))
+        self.log_loop_end(t_loop, busy_loop)
+
+    def log_loop_end(self, t_loop, busy_loop):
+        #running speculative searches are waited for, their engine time counts
+        self.drop_speculative()
+        concurrent.futures.wait(list(self.speculative_kept.values()))
+        kept = len(self.speculative_kept)
+        self.speculative_kept = {}
+        s = "loop %.3fs, %s" % (time.time() - t_loop, self.utilisation_str(busy_loop, self.engine_busy(), time.time() - t_loop))
+        if self.speculative_submitted:
+            s += ", speculative: %i submitted, %i adopted, %i reused, %i cancelled, %i unused" % (
+                self.speculative_submitted, self.speculative_adopted, self.speculative_reused, self.speculative_cancelled, kept)
+        self.log.print_s(s)
+        self.alpha_beta_log.print_s(s)
+
+parallel_search = None
+
+def search_graph_task(task):
+    #runs in pool worker, its UndoSearch is the copy of start_parallel_pool, graph and on_path
+    #of split point are mapped once per search, on_path is same again after every child search
+    s = parallel_search
+    filename, search_id, sizes, node, turn, alpha, beta = task
+    if s.parallel_search_id!=search_id:
+        s.attach_graph(filename, search_id, sizes)
+    s.graph_history = dict(s.fork_history)
+    s.alpha_beta_nodes = 0
+    score, pv = s.search_graph_child(node, turn, alpha, beta)
+    history = {node: code for node, code in s.graph_history.items() if s.fork_history.get(node)!=code}
+    return score, pv, s.alpha_beta_nodes, history
+
+def find_cyclic(link_to):
+    #iterative Tarjan, returns positions that belong to some cycle of the link graph
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    cyclic = set()
+    for root in link_to:
+        if root in index: continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(link_to[root]))]
+        while work:
+            pos, children = work[-1]
+            for pos2 in children:
+                if pos2 not in index:
+                    index[pos2] = low[pos2] = len(index)
+                    stack.append(pos2)
+                    on_stack.add(pos2)
+                    work.append((pos2, iter(link_to.get(pos2, ()))))
+                    break
+                elif pos2 in on_stack:
+                    low[pos] = min(low[pos], index[pos2])
+            else:
+                work.pop()
+                if work:
+                    pos0 = work[-1][0]
+                    low[pos0] = min(low[pos0], low[pos])
+                if low[pos]==index[pos]:
+                    scc = []
+                    while True:
+                        pos2 = stack.pop()
+                        on_stack.discard(pos2)
+                        scc.append(pos2)
+                        if pos2==pos: break
+                    if len(scc)>1 or pos in link_to.get(pos, ()):
+                        cyclic.update(scc)
+    return cyclic
+
 def moves2board(startpos, moves):
     b = chess.Board(startpos)
     for m in moves:
@@ -438,18 +1601,46 @@ def moves2san(startpos, moves):
     b = moves2board(startpos, moves)
     return board2san(startpos, b)
 
-def count_pieces(board):
-    count = 0
-    for color in chess.COLORS:
-        for piece_type in chess.PIECE_TYPES:
-            count += len(board.pieces(piece_type, color))
-    return count
-
 if __name__=="__main__":
     if not os.path.exists("log"): os.mkdir("log")
+    if sys.argv[1]=="rebuild_links":
+        s = UndoSearch(0, 0, links=False)
+        s.rebuild_links()
+        s.log.print_s("%i links stored" % (s.link_count,))
+        sys.exit()
+    if sys.argv[1]=="export_snapshot":
+        s = UndoSearch(0, 0)
+        s.export_snapshot()
+        sys.exit()
+    if sys.argv[1]=="retrograde":
+        s = UndoSearch(0, 0)
+        s.retrograde()
+        sys.exit()
+    if sys.argv[1]=="refine":
+        #refine nodes2search [engine_count]
+        if len(sys.argv)>3: engine_count = int(sys.argv[3])
+        else: engine_count = ENGINE_COUNT
+        s = UndoSearch(int(sys.argv[2]), engine_count)
+        s.refine()
+        s.writer.close()
+        if SNAPSHOT_FLAG: s.export_snapshot()
+        sys.exit()
+    if sys.argv[1]=="compare_multipv":
+        #compare_multipv time_in_milliseconds_per_move [engine_count]
+        if len(sys.argv)>3: engine_count = int(sys.argv[3])
+        else: engine_count = ENGINE_COUNT
+        s = UndoSearch(int(sys.argv[2]), engine_count)
+        score, pv = s.search_alpha_beta()
+        s.compare_multipv(pv)
+        sys.exit()
     nodes2search = int(sys.argv[1])
-    s = UndoSearch(nodes2search)
+    if len(sys.argv)>2: engine_count = int(sys.argv[2])
+    else: engine_count = ENGINE_COUNT
+    s = UndoSearch(nodes2search, engine_count)
     s.loop()
+    s.writer.close()
+    metrics.close()
+    if SNAPSHOT_FLAG: s.export_snapshot()
     #score, pv = s.search_alpha_beta(True)
     #s.search_variation(pv); s.commit(); s.search_alpha_beta(True); s.search_alpha_beta(False)
     #s.search()